@@ -1,113 +1,36 @@
 import tkinter as tk
-from tkinter import ttk, filedialog
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from ipaddress import IPv4Network, IPv4Interface
+from tkinter import ttk, filedialog, messagebox
 import os
-import subprocess
 import time
-from threading import Thread, Event
-import requests
+from threading import Thread
+from queue import Empty
 import webbrowser
-import socket
+from pathlib import Path
+
+from timelapse_engine import (
+    METRICS_HOST,
+    METRICS_LOG,
+    METRICS_PORT,
+    SNAPSHOT_DIR,
+    WEEKDAYS,
+    ScheduleWindow,
+    TimelapseEngine,
+    FFmpegNotFoundError,
+    calculate_timelapse_data,
+    describe_estimate,
+    estimator,
+    discover_cameras,
+    get_ffmpeg_path,
+    is_session_folder,
+    preview_session,
+    unfinished_sessions,
+)
+from timelapse_metrics import start_metrics
+
+EVENT_POLL_MS = 250  # How often the window takes in events from the engine and discovery
+EVENT_BATCH = 2000  # Most events taken in per poll, so a burst can't hold up the window
+HEALTH_COLOURS = {'ok': 'dark green', 'degraded': 'dark orange', 'down': 'red'}
 
-# Configuration
-IP_FILE = './IP.txt'
-IP_RANGE_FILE = './IP_range.txt'
-SNAPSHOT_DIR = './snapshots/'
-CHECK_EXTENSION = "/snap.jpeg"
-FFMPEG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ffmpeg.exe')
-
-def calculate_timelapse_data(frequency, frame_rate, avg_size_kb=500):
-    frames_per_hour = 3600 / frequency
-    filesize_per_hour_mb = (frames_per_hour * avg_size_kb) / 1024
-    footage_duration_seconds = frames_per_hour / frame_rate
-
-    return int(frames_per_hour), int(filesize_per_hour_mb), int(footage_duration_seconds)
-
-def is_ffmpeg_installed():
-    try:
-        result = subprocess.run(["where", "ffmpeg"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # Check if the path returned by the 'where' command is NOT the local directory
-        return os.path.dirname(os.path.abspath(result.stdout.decode().strip())) != os.path.dirname(os.path.abspath(__file__))
-    except:
-        return False
-
-def get_ffmpeg_path():
-    if is_ffmpeg_installed():
-        print("Using system-wide installation of FFMpeg.")
-        return "ffmpeg"
-    else:
-        if os.path.exists(FFMPEG_PATH):
-            print(f"Using local FFMpeg executable at {FFMPEG_PATH}.")
-            return FFMPEG_PATH
-        else:
-            print("Error: FFMpeg not found!")
-            print("Please ensure FFMpeg is either installed system-wide or the ffmpeg.exe is present in the script directory.")
-            exit(1)  # This will halt the programme
-
-ffmpeg_path = get_ffmpeg_path()
-
-def get_default_ip_range():
-    # Get the IP address of the machine
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        # Doesn't have to be reachable, it's just to get the IP address bound to a network interface
-        s.connect(('10.254.254.254', 1))
-        ip_address = s.getsockname()[0]
-    except Exception:
-        ip_address = '127.0.0.1'
-    finally:
-        s.close()
-
-    # Assuming a /24 subnet for simplicity
-    subnet = IPv4Interface(f'{ip_address}/24').network
-    return str(subnet)
-
-def discover_cameras():
-    # Try reading from IP.txt first
-    if os.path.exists(IP_FILE) and os.path.getsize(IP_FILE) > 0:
-        with open(IP_FILE, 'r') as file:
-            return [line.strip() for line in file.readlines()]
-    else:
-        print("IP.txt not found, starting network discovery...")
-
-    # Check if IP_range.txt exists and read the first line for the IP range
-    ip_range = get_default_ip_range()
-    if os.path.exists(IP_RANGE_FILE):
-        with open(IP_RANGE_FILE, "r") as file:
-            custom_ip_range = file.readline().strip()
-            if custom_ip_range:
-                ip_range = custom_ip_range
-                print(f"Using IP range from IP_range.txt: {ip_range}")
-            else:
-                print(f"IP_range.txt is empty. Using detected IP range: {ip_range}")
-    else:
-        print(f"IP_range.txt not found. Using detected IP range: {ip_range}")
-
-    # Discover cameras on the network using the specified or default IP range
-    print("Starting camera discovery...")
-    found_cameras = []
-    with ThreadPoolExecutor(max_workers=100) as executor:
-        futures = {executor.submit(check_camera, str(ip)): ip for ip in IPv4Network(ip_range)}
-        for future in as_completed(futures):
-            ip = futures[future]
-            try:
-                result = future.result()
-                if result:
-                    print(f"Discovered camera at {result}")
-                    found_cameras.append(result)
-            except Exception as exc:
-                print(f'{ip} generated an exception: {exc}')
-    return found_cameras
-
-def check_camera(ip):
-    try:
-        response = requests.get(f"http://{ip}{CHECK_EXTENSION}", timeout=1)
-        if response.status_code == 200 and response.headers.get('Content-Type') == 'image/jpeg':
-            return ip
-    except requests.RequestException:
-        pass
-    return None
 class CameraApp(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -116,12 +39,12 @@ class CameraApp(tk.Tk):
         self.schedule_set = False
         self.schedule_check_active = False
         self.total_captures_var = tk.StringVar()
-        self.manual_stop = False
-        self.waiting_to_start = False
-        self.check_schedule_id = None
         self.blinking_state = False
-        self.capturing = Event()
-        self.last_printed_schedule = None
+        self.last_schedule_state = None
+
+        # Everything that actually captures, schedules and encodes lives in the engine, this is just the window onto it
+        self.engine = TimelapseEngine()
+        self.capturing = self.engine.capturing
         
         # Initialize the attribute
         self.is_schedule_running = False
@@ -136,25 +59,29 @@ class CameraApp(tk.Tk):
         # Now initialize self.total_filesize_var
         self.total_filesize_var = tk.StringVar(self.main_frame, value="Total Filesize: 0MB")
         
-        # Internal state
-        self.capturing = Event()
-
         # Initializing counters
-        self.start_time = None
         self.total_captures = 0
         self.total_filesize = 0
-             
-        # Setting up the counters update method to be called every second
-        self.after(1000, self.update_counters)
+
+        # Everything the engine and camera discovery have to tell us comes in on this queue, drained on the Tk thread
+        self.events = self.engine.subscribe()
 
         self.setup_gui()
+        self.after(EVENT_POLL_MS, self.drain_events)
+
+        # Offer to pick up a session the last run didn't get to finish
+        self.after(500, self.offer_resume)
 
     # Helper function for disabling user input when captures are running
     def set_widget_states(self, state):
         # Optionally uncheck all checkboxes when disabling
-        for chk in self.main_frame.winfo_children():
+        for chk in self.main_frame.winfo_children() + self.days_frame.winfo_children():
             if isinstance(chk, tk.Checkbutton):
                 chk.configure(state=state)
+
+        # The camera list stays scrollable and searchable, it just can't be changed
+        self.select_shown_button.configure(state=state)
+        self.select_none_button.configure(state=state)
         
         # Disable/Enable Entry boxes and Dropdowns
         self.snapshot_freq.configure(state=state)
@@ -183,6 +110,7 @@ class CameraApp(tk.Tk):
 
         # Timelapse estimated stats var
         self.timelapse_data_var = tk.StringVar(value="")
+        self.estimate_var = tk.StringVar(value="")
         
         # Camera selection, snapshot frequency, and FPS settings
         camera_heading = ttk.Label(self.main_frame, text="Select your Cameras", font=("Arial", 10, "bold"))
@@ -191,13 +119,50 @@ class CameraApp(tk.Tk):
         label = ttk.Label(self.main_frame, text=explainer_text, wraplength=300)
         label.pack(pady=(0, 0))
         
-        # Discover Cameras and Display on GUI
-        self.cameras = discover_cameras()
-        self.camera_vars = {camera: tk.BooleanVar() for camera in self.cameras}
-
-        for camera, var in self.camera_vars.items():
-            chk = tk.Checkbutton(self.main_frame, text=camera, variable=var, command=self.check_cameras_selected)
-            chk.pack(pady=0)
+        # Discover Cameras in the background and add them to the GUI as they turn up
+        self.discovery_status_var = tk.StringVar(value="Searching for cameras...")
+        ttk.Label(self.main_frame, textvariable=self.discovery_status_var).pack(pady=0)
+
+        # One row per camera with how it's doing, filtered by the search box. Click a row (or select a few and press
+        # space) to tick it. A Treeview only draws the rows on screen, so hundreds of cameras cost next to nothing.
+        self.camera_frame = tk.Frame(self.main_frame)
+        self.camera_frame.pack(pady=0)
+        self.cameras = []
+        self.selected = set()
+        self.camera_rows = {}  # camera -> the (values, tags) it was last drawn with
+        self.camera_health = {}
+        self.camera_filter_var = tk.StringVar()
+        search_frame = tk.Frame(self.camera_frame)
+        search_frame.pack(fill=tk.X)
+        ttk.Label(search_frame, text="Search:").pack(side=tk.LEFT)
+        ttk.Entry(search_frame, textvariable=self.camera_filter_var).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.camera_filter_var.trace_add('write', lambda *args: self.filter_cameras())
+        tree_frame = tk.Frame(self.camera_frame)
+        tree_frame.pack()
+        self.camera_tree = ttk.Treeview(tree_frame, columns=('camera', 'status'), show='headings', height=8,
+                                        selectmode='extended')
+        self.camera_tree.heading('camera', text="Camera")
+        self.camera_tree.heading('status', text="Status")
+        self.camera_tree.column('camera', width=180)
+        self.camera_tree.column('status', width=160)
+        for state, colour in HEALTH_COLOURS.items():
+            self.camera_tree.tag_configure(state, foreground=colour)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.camera_tree.yview)
+        self.camera_tree.configure(yscrollcommand=scrollbar.set)
+        self.camera_tree.pack(side=tk.LEFT)
+        scrollbar.pack(side=tk.LEFT, fill=tk.Y)
+        self.camera_tree.bind('<ButtonRelease-1>', self.on_camera_click)
+        self.camera_tree.bind('<space>', lambda event: self.toggle_cameras(self.camera_tree.selection()))
+        camera_buttons = tk.Frame(self.camera_frame)
+        camera_buttons.pack(pady=2)
+        self.select_shown_button = tk.Button(camera_buttons, text="Select Shown",
+                                             command=lambda: self.set_cameras_selected(self.camera_tree.get_children(), True))
+        self.select_shown_button.grid(row=0, column=0, padx=5)
+        self.select_none_button = tk.Button(camera_buttons, text="Select None",
+                                            command=lambda: self.set_cameras_selected(list(self.selected), False))
+        self.select_none_button.grid(row=0, column=1, padx=5)
+
+        Thread(target=self.discover, daemon=True).start()
 
         ttk.Label(self.main_frame, text="Snapshot Frequency (s):").pack(pady=5)
         self.snapshot_freq = tk.Entry(self.main_frame)
@@ -209,6 +174,26 @@ class CameraApp(tk.Tk):
         self.video_framerate.insert(0, "24")  # Default value of 24
         self.video_framerate.pack(pady=5)
 
+        # Encode as we go, so the video is ready a few seconds after stopping
+        self.stream_encode_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.main_frame, text="Encode video while capturing", variable=self.stream_encode_var).pack(pady=0)
+
+        # Don't bother keeping frames where nothing has changed
+        self.dedup_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.main_frame, text="Skip near-identical frames", variable=self.dedup_var).pack(pady=0)
+
+        # Stagger the cameras across the interval rather than fetching them all in one burst
+        self.spread_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.main_frame, text="Spread snapshots across the interval", variable=self.spread_var).pack(pady=0)
+
+        # One file per camera per session instead of one per frame, much kinder to NAS drives on long sessions
+        self.container_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.main_frame, text="Store frames in a single file per camera", variable=self.container_var).pack(pady=0)
+
+        # Smooth out auto-exposure jumps at dawn and dusk, applies to Convert Existing Images too
+        self.deflicker_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.main_frame, text="Even out exposure flicker", variable=self.deflicker_var).pack(pady=0)
+
         # Attach event listeners
         self.snapshot_freq.bind("<KeyRelease>", self.update_timelapse_data_display)
         self.video_framerate.bind("<KeyRelease>", self.update_timelapse_data_display)
@@ -218,7 +203,9 @@ class CameraApp(tk.Tk):
 
         # Add the label to the GUI
         self.timelapse_data_label = ttk.Label(self.main_frame, textvariable=self.timelapse_data_var)
-        self.timelapse_data_label.pack(pady=(5, 5))
+        self.timelapse_data_label.pack(pady=(5, 0))
+        self.estimate_label = ttk.Label(self.main_frame, textvariable=self.estimate_var, wraplength=300, justify=tk.CENTER)
+        self.estimate_label.pack(pady=(0, 5))
 
         # Section 2: Immediate Capture Session
         create_section_header("One-Click Start")
@@ -236,7 +223,7 @@ class CameraApp(tk.Tk):
 
         # Section 3: Schedule Setup
         create_section_header("Schedule Your Recording")
-        explainer_text = ("Or if you prefer to set a schedule, a timelapse will be created every day at the set times. \n\nOnce the schedule has started, clicking \"Stop Schedule\" will stop the schedule and immediately create a timelapse of the captured images. ")
+        explainer_text = ("Or if you prefer to set a schedule, a timelapse will be created on the ticked days at the set times. An end time before the start time records overnight. \n\nOnce the schedule has started, clicking \"Stop Schedule\" will stop the schedule and immediately create a timelapse of the captured images. ")
         label = ttk.Label(self.main_frame, text=explainer_text, wraplength=300)
         label.pack(pady=(0, 10))
         
@@ -283,6 +270,15 @@ class CameraApp(tk.Tk):
         self.end_ampm_dropdown = ttk.Combobox(end_frame, textvariable=self.end_ampm_var, values=["AM", "PM"], width=3)
         self.end_ampm_dropdown.grid(row=0, column=2, padx=5)
 
+        # Which days the schedule runs on, every day by default
+        self.days_frame = tk.Frame(self.main_frame)
+        self.days_frame.pack(pady=2)
+        self.weekday_vars = []
+        for day, name in enumerate(WEEKDAYS):
+            var = tk.BooleanVar(value=True)
+            tk.Checkbutton(self.days_frame, text=name.title(), variable=var).grid(row=0, column=day)
+            self.weekday_vars.append(var)
+
         self.schedule_status_var = tk.StringVar(self.main_frame, value="Schedule: Not Running")
         self.schedule_status_label = ttk.Label(self.main_frame, textvariable=self.schedule_status_var)
         self.schedule_status_label.pack(pady=5)
@@ -309,9 +305,15 @@ class CameraApp(tk.Tk):
         self.video_length_var = tk.StringVar(self.main_frame, value="Estimated Video Length: 0s")
         ttk.Label(self.main_frame, textvariable=self.video_length_var).pack(pady=0)
 
+        self.skipped_var = tk.StringVar(self.main_frame, value="Skipped Duplicates: 0 (0.00 MB)")
+        ttk.Label(self.main_frame, textvariable=self.skipped_var).pack(pady=0)
+
+        self.disk_var = tk.StringVar(self.main_frame, value="")
+        ttk.Label(self.main_frame, textvariable=self.disk_var).pack(pady=0)
+
         # Section 5: Convert Existing Images
         create_section_header("Convert Stored Snapshots")
-        explainer_text = ("Click the button below and select a folder with previously captured images.")
+        explainer_text = ("Click the button below and select a folder with previously captured images. Pick a camera's folder (or the whole snapshots folder) to convert every session in it that doesn't have a video yet.")
         label = ttk.Label(self.main_frame, text=explainer_text, wraplength=300)
         label.pack(pady=(0, 0))
 
@@ -319,6 +321,19 @@ class CameraApp(tk.Tk):
         self.convert_button = tk.Button(self.main_frame, text="Convert Existing Images", command=self.convert_existing_images)
         self.convert_button.pack(pady=10)
 
+        # A low-res preview and contact sheet in seconds (works on the session being recorded too), the full video follows in the background
+        self.preview_button = tk.Button(self.main_frame, text="Quick Preview", command=self.preview_existing_images)
+        self.preview_button.pack(pady=(0, 10))
+
+        # Conversions run in the background, this is where their progress shows up
+        self.conversion_list = tk.Listbox(self.main_frame, height=5, width=60)
+        self.conversion_list.pack(pady=0)
+        conversion_buttons = tk.Frame(self.main_frame)
+        conversion_buttons.pack(pady=5)
+        tk.Button(conversion_buttons, text="Cancel Conversions", command=self.engine.conversions.cancel).grid(row=0, column=0, padx=5)
+        tk.Button(conversion_buttons, text="Resume", command=self.engine.conversions.resume).grid(row=0, column=1, padx=5)
+        tk.Button(conversion_buttons, text="Clear Finished", command=self.engine.conversions.clear_finished).grid(row=0, column=2, padx=5)
+
         github_link = ttk.Label(self.main_frame, 
                                 text="Visit My GitHub", 
                                 font=("Arial", 8, "underline"),
@@ -337,16 +352,143 @@ class CameraApp(tk.Tk):
                             font=("Arial", 8))
         copyright_label.pack(side=tk.BOTTOM)
 
+    def discover(self):
+        # Runs on its own thread, cameras go to the window through the event queue as they're found
+        found = discover_cameras(lambda camera: self.events.put(('camera_found', camera)))
+        self.events.put(('discovery_done', len(found)))
+
+    def drain_events(self):
+        # Takes in everything queued since last time. Only the newest status and conversion list matter,
+        # cameras found are added in one go.
+        latest = {}
+        found = []
+        for _ in range(EVENT_BATCH):
+            try:
+                kind, data = self.events.get_nowait()
+            except Empty:
+                break
+            if kind == 'camera_found':
+                found.append(data)
+            else:
+                latest[kind] = data
+        if found:
+            for camera in found:
+                if camera not in self.camera_rows:
+                    self.add_camera(camera)
+            self.filter_cameras()
+            self.discovery_status_var.set(f"Searching for cameras... ({len(self.cameras)} found)")
+        if 'discovery_done' in latest:
+            self.discovery_status_var.set(f"Found {len(self.cameras)} camera(s)")
+        if 'status' in latest:
+            self.update_counters(latest['status'])
+        if 'conversions' in latest:
+            self.update_conversions(latest['conversions'])
+        self.after(EVENT_POLL_MS, self.drain_events)
+
+    def cameras_locked(self):
+        return self.capturing.is_set() or self.is_schedule_running
+
+    def add_camera(self, camera, selected=False):
+        self.cameras.append(camera)
+        if selected:
+            self.selected.add(camera)
+        self.camera_tree.insert('', tk.END, iid=camera)
+        self.draw_camera(camera)
+
+    def draw_camera(self, camera):
+        # Only touches the row if something about it has changed
+        health = self.camera_health.get(camera)
+        status = health.describe() if health is not None else ""
+        tags = (health.state,) if health is not None else ()
+        row = ((('\u2611 ' if camera in self.selected else '\u2610 ') + camera, status), tags)
+        if self.camera_rows.get(camera) != row:
+            self.camera_rows[camera] = row
+            self.camera_tree.item(camera, values=row[0], tags=row[1])
+
+    def filter_cameras(self):
+        # Detached rows keep their place in self.cameras, so clearing the search puts them back in order
+        text = self.camera_filter_var.get().strip().lower()
+        position = 0
+        for camera in self.cameras:
+            if text in camera.lower():
+                self.camera_tree.move(camera, '', position)
+                position += 1
+            else:
+                self.camera_tree.detach(camera)
+
+    def on_camera_click(self, event):
+        # A plain click ticks or unticks the row, shift/ctrl clicks just select rows for the space bar
+        if event.state & 0x0005 or self.camera_tree.identify_region(event.x, event.y) != 'cell':
+            return
+        camera = self.camera_tree.identify_row(event.y)
+        if camera:
+            self.toggle_cameras([camera])
+
+    def toggle_cameras(self, cameras):
+        if self.cameras_locked():
+            return
+        for camera in cameras:
+            self.selected.symmetric_difference_update({camera})
+            self.draw_camera(camera)
+        self.check_cameras_selected()
+
+    def set_cameras_selected(self, cameras, selected):
+        if self.cameras_locked():
+            return
+        for camera in cameras:
+            if selected:
+                self.selected.add(camera)
+            else:
+                self.selected.discard(camera)
+            self.draw_camera(camera)
+        self.check_cameras_selected()
+
+    def offer_resume(self):
+        journals = unfinished_sessions()
+        if not journals:
+            return
+        capturing = [journal for journal in journals if not journal.stopped]
+        if capturing:
+            journal = capturing[0]
+            resume = messagebox.askyesno(
+                "Resume Session",
+                f"The session started {time.strftime('%a %d %b %H:%M', time.localtime(journal.started))} with "
+                f"{len(journal.cameras)} camera(s) was cut short.\n\nCarry on capturing into it? "
+                f"Choosing No just finishes its video.")
+        else:
+            resume = False
+        # Either way any unfinished videos get finished, they show up in the conversions list
+        resumed = self.engine.resume_sessions(journals, capture=resume)
+        if resumed is None:
+            return
+
+        # Show the resumed session as if it had been started from here
+        for camera in resumed.cameras:
+            if camera in self.camera_rows:
+                self.selected.add(camera)
+                self.draw_camera(camera)
+            else:
+                self.add_camera(camera, selected=True)
+        self.show_capturing()
+
     def update_timelapse_data_display(self, event=None):
         # Get current values from the entry boxes
         try:
             frequency = float(self.snapshot_freq.get())
             frame_rate = float(self.video_framerate.get())
             
-            frames, filesize, duration = calculate_timelapse_data(frequency, frame_rate)
+            # Frame sizes, fetch times and encode speeds are measured from past captures of these cameras
+            cameras = self.selected_cameras()
+            frames, filesize, duration = calculate_timelapse_data(frequency, frame_rate, cameras=cameras)
             self.timelapse_data_var.set(f"{frames} frames, {filesize}MB, {duration} seconds of footage per camera per hour.")
-        except ValueError:  # This will handle cases where the entry boxes might not have valid numbers
+            estimate = estimator.estimate(cameras, frequency, frame_rate)
+            text = describe_estimate(estimate)
+            if cameras and frequency < estimate['min_interval']:
+                text += f"\nEvery {frequency:g}s is faster than these cameras can keep up with."
+            self.estimate_var.set(text)
+        except (ValueError, ZeroDivisionError):  # This will handle cases where the entry boxes might not have valid numbers
             self.timelapse_data_var.set("Enter valid snapshot frequency and frame rate.")
+            self.estimate_var.set("")
 
     def toggle_schedule(self):
         # Oh, look who's trying to start the schedule!
@@ -375,15 +517,15 @@ class CameraApp(tk.Tk):
 
             # Look at you, turning the schedule on!
             self.is_schedule_running = True
+            self.last_schedule_state = None
             self.schedule_status_var.set("Schedule is active. Waiting to start capturing...")
             self.schedule_status_label.config(foreground="red", font=("Arial", 10, "bold"))
             self.schedule_button.config(text="Stop Schedule", bg="red", fg="white", font=("Arial", 10, "bold"))
             
-            # Reset the manual_stop flag. We're doing things automatically now!
-            self.manual_stop = False  
-
-            # Let's keep an eye on the time and see when it's showtime
-            self.check_schedule_id = self.after(10000, self.check_schedule)
+            # Hand the schedule over to the engine, it'll start and stop capturing at the right times
+            weekdays = [day for day, var in enumerate(self.weekday_vars) if var.get()]
+            window = ScheduleWindow(self.start_time_schedule, self.end_time_schedule, weekdays)
+            self.engine.start_schedule([window], self.selected_cameras(), **self.capture_settings())
 
             # If starting the schedule, disable all widgets
             if self.is_schedule_running:
@@ -407,22 +549,17 @@ class CameraApp(tk.Tk):
             self.schedule_button.config(text="Start Schedule", bg="yellow", fg="black", font=("Arial", 10, "bold"))
             self.stop_button.config(state=tk.NORMAL)  # Re-enable the "Stop Capturing" button
                     
-            # If capturing is active, we're shutting it down!
-            if self.capturing.is_set():
-                self.stop_capture()
+            # If capturing is active, the engine shuts it down (and makes the video) along with the schedule.
+            # That can take a while, so it happens on the same worker thread as a normal stop.
+            self.stop_capture(stop_schedule=True)
                     
             # Let's bring back the other buttons, just in case you want to use them
-            # Revert the background color of start and stop buttons to their original colors
-            self.start_button.config(state=tk.NORMAL, bg="green")
+            # Start comes back once the videos are done (see finish_stop_capture)
             self.stop_button.config(state=tk.DISABLED, bg="red")
             self.convert_button.config(state=tk.NORMAL)
 
             # Re-enable the user input widgets
             self.set_widget_states(tk.NORMAL)
-            
-            # Stopping the check_schedule loop, because we're not waiting anymore
-            if hasattr(self, 'check_schedule_id'):
-                self.after_cancel(self.check_schedule_id)
 
     def toggle_blink(self):
         if self.is_schedule_running and self.capturing.is_set():
@@ -433,72 +570,27 @@ class CameraApp(tk.Tk):
             self.blinking_state = not self.blinking_state
             self.after(500, self.toggle_blink)  # Call every 500ms for blinking effect
         
-    def check_schedule(self):
-        # If the schedule isn't running, don't proceed with the check.
-        if not hasattr(self, 'is_schedule_running') or not self.is_schedule_running:
-            return
-        # Prevent multiple simultaneous invocations of this method
-        if hasattr(self, 'is_checking_schedule') and self.is_checking_schedule:
-            return
-
-        self.is_checking_schedule = True
-
-        current_time = time.strftime("%H:%M")
-
-        # Only print the schedule if it has changed since the last check
-        if not hasattr(self, 'last_printed_schedule') or self.last_printed_schedule != (self.start_time_schedule, self.end_time_schedule):
-            print("Current Time:", current_time)
-            print("Start Time Schedule:", self.start_time_schedule)
-            print("End Time Schedule:", self.end_time_schedule)
-            self.last_printed_schedule = (self.start_time_schedule, self.end_time_schedule)
-
-        if current_time >= self.start_time_schedule and current_time <= self.end_time_schedule:
-            print("Inside scheduled time.")
-            if not self.capturing.is_set() and self.is_schedule_running and not self.manual_stop:
-                self.start_capture()
-                self.schedule_status_var.set("CURRENTLY RECORDING")
-                self.schedule_status_label.config(foreground="red", font=("Arial", 10, "bold"))
-                self.toggle_blink()
-        else:
-            print("Outside scheduled time.")
-            if self.capturing.is_set():
-                self.stop_capture()
-            # Since we're outside the scheduled time, set waiting_to_start to True
-            self.waiting_to_start = True
-            if self.is_schedule_running:  # Check if the schedule is still active
-                self.schedule_status_var.set("Waiting for next scheduled time...")
-                self.schedule_status_label.config(foreground="blue", font=("Arial", 10))
-                self.toggle_blink()
-
-        # Schedule the next check after 10 seconds (10000 milliseconds) instead of 60 seconds
-        self.after(10000, self.check_schedule) 
-        self.is_checking_schedule = False
-        
-    def update_counters(self):
-        if self.capturing.is_set() and self.start_time:
+    def update_counters(self, status):
+        # status comes from the engine's status events, see drain_events
+        if status['capturing']:
             # Update Elapsed Time
-            elapsed_seconds = int(time.time() - self.start_time)
+            elapsed_seconds = int(status['elapsed'])
             hours, remainder = divmod(elapsed_seconds, 3600)
             minutes, seconds = divmod(remainder, 60)
             self.elapsed_time_var.set(f"Elapsed Time: {hours}:{minutes:02}:{seconds:02}")
 
-            # Update Captures Counter (based on files created for the current session)
-            session_folder = os.path.join(SNAPSHOT_DIR, self.cameras[0], self.session_start_time)  # Assuming all cameras save in the same session folder
-            if os.path.exists(session_folder):
-                    self.total_captures = len([f for f in os.listdir(session_folder) if f.endswith('.jpeg')])
-                    self.total_filesize = sum([os.path.getsize(os.path.join(session_folder, f)) 
-                                               for f in os.listdir(session_folder) if f.endswith('.jpeg')]) / (1024 * 1024)  # in MB
-            else:
-                self.total_captures = 0
-                self.total_filesize = 0
+            # Update Captures Counter (straight from the session manifests, no folder scanning)
+            self.total_captures = status['captures']
+            self.total_filesize = status['bytes'] / (1024 * 1024)  # in MB
                     
             # Update the UI with the new counter values
             self.captures_var.set(f"Total Captures: {self.total_captures}")
             self.filesize_var.set(f"Total Filesize: {self.total_filesize:.2f} MB")
+            self.skipped_var.set(f"Skipped Duplicates: {status['skipped_frames']} ({status['skipped_bytes'] / (1024 * 1024):.2f} MB)")
             
-            # Update Estimated Video Length
+            # Update Estimated Video Length (each camera gets its own video, so go by the longest one)
             framerate = int(self.video_framerate.get() or '30')
-            estimated_length = self.total_captures / framerate
+            estimated_length = status['longest_video_frames'] / framerate
             minutes, seconds = divmod(estimated_length, 60)
             
             # Formatting the estimated video length
@@ -506,20 +598,72 @@ class CameraApp(tk.Tk):
         
             self.video_length_var.set(formatted_length)
 
-        # Schedule the next update
-        self.after(1000, self.update_counters)
+        self.update_disk_display(status['disk'])
+        self.update_camera_health_display(status['health'])
+        self.update_schedule_display(status['schedule_state'], status['schedule_next_change'])
+
+    def update_disk_display(self, disk):
+        text = f"Disk Free: {disk['free'] / (1024 ** 3):.1f} GB"
+        if disk['full_in'] is not None:
+            hours = disk['full_in'] / 3600
+            text += f" (full in ~{hours / 24:.1f} days)" if hours >= 48 else f" (full in ~{hours:.1f} hours!)"
+        self.disk_var.set(text)
+
+    def update_schedule_display(self, schedule_state, next_change=None):
+        # The engine decides when to record, we just mirror what it's doing
+        if not self.is_schedule_running or (schedule_state, next_change) == self.last_schedule_state:
+            return
+        self.last_schedule_state = (schedule_state, next_change)
+        if schedule_state == 'recording':
+            self.schedule_status_var.set("CURRENTLY RECORDING")
+            self.schedule_status_label.config(foreground="red", font=("Arial", 10, "bold"))
+            self.toggle_blink()
+        elif schedule_state == 'waiting':
+            self.blinking_state = False
+            if next_change is not None:
+                self.schedule_status_var.set(f"Waiting, next recording starts {next_change:%a %H:%M}")
+            else:
+                self.schedule_status_var.set("Waiting for next scheduled time...")
+            self.schedule_status_label.config(foreground="blue", font=("Arial", 10))
+
+    def update_camera_health_display(self, camera_health):
+        # Show how each capturing camera is doing in its row, cameras that aren't being captured have a blank status
+        self.camera_health = camera_health if self.capturing.is_set() else {}
+        for camera in self.cameras:
+            self.draw_camera(camera)
 
     def check_cameras_selected(self):
+        self.update_timelapse_data_display()
         # If any camera is selected, enable the 'Start Schedule' button. Simple!
-        for var in self.camera_vars.values():
-            if var.get():
-                self.start_button.config(state=tk.NORMAL)
-                self.schedule_button.config(state=tk.NORMAL)
-                return
-        self.start_button.config(state=tk.DISABLED)
-        self.schedule_button.config(state=tk.DISABLED)
+        state = tk.NORMAL if self.selected else tk.DISABLED
+        self.start_button.config(state=state)
+        self.schedule_button.config(state=state)
+
+    def selected_cameras(self):
+        return [camera for camera in self.cameras if camera in self.selected]
+
+    def capture_settings(self):
+        # Check if snapshot_freq is filled, otherwise default to 10 seconds
+        try:
+            capture_frequency = int(self.snapshot_freq.get())
+        except ValueError:
+            capture_frequency = 10  # default value
+        return {
+            'frequency': capture_frequency,
+            'framerate': self.video_framerate.get() or '24',  # default to 24fps if not provided
+            'stream_encode': self.stream_encode_var.get(),
+            'dedup': self.dedup_var.get(),
+            'spread': self.spread_var.get(),
+            'storage': 'container' if self.container_var.get() else 'files',
+            'deflicker': self.deflicker_var.get(),
+        }
 
     def start_capture(self):
+        settings = self.capture_settings()
+        self.show_capturing()
+        self.engine.start_capture(self.selected_cameras(), **settings)
+
+    def show_capturing(self):
         # Immediately change the button states
         self.start_button.config(state=tk.DISABLED, bg="grey")
         self.schedule_button.config(state="disabled", bg="grey")
@@ -530,22 +674,6 @@ class CameraApp(tk.Tk):
         self.schedule_status_label.config(foreground="red", font=("Arial", 10, "bold"))
         self.toggle_blink()
 
-        # Check if snapshot_freq is filled, otherwise default to 10 seconds
-        try:
-            capture_frequency = int(self.snapshot_freq.get())
-        except ValueError:
-            capture_frequency = 10  # default value
-
-        # If scheduling is active and we're outside the scheduled times, set up to check the schedule
-        if hasattr(self, 'is_schedule_running') and self.is_schedule_running:
-            current_time = time.strftime("%H:%M")
-            if not (self.start_time_schedule <= current_time <= self.end_time_schedule):
-                self.waiting_to_start = True
-                self.after(1000, self.check_schedule)
-                return
-
-        self.begin_capture()
-
         # Disable all widgets
         self.set_widget_states(tk.DISABLED)
 
@@ -553,108 +681,56 @@ class CameraApp(tk.Tk):
         if not (hasattr(self, 'is_schedule_running') and self.is_schedule_running):
             self.stop_button.config(state=tk.NORMAL)
 
-    def begin_capture(self):
-        self.capturing.set()
-        self.session_start_time = time.strftime("%Y-%m-%d_%H-%M-%S")
-        
-        # Reset counters
-        self.start_time = time.time()
-        self.total_captures = 0
-        self.total_filesize = 0
-
-        # Reset the manual_stop flag
-        self.manual_stop = False
-
-        # Check if snapshot_freq is filled, otherwise default to 5 seconds
-        try:
-            capture_frequency = int(self.snapshot_freq.get())
-        except ValueError:
-            capture_frequency = 10  # default value
-            
-        Thread(target=self.capture_images, args=(capture_frequency,)).start()
-        
-    def capture_images(self, frequency):    
-        while self.capturing.is_set():
-            for camera, var in self.camera_vars.items():
-                if var.get():
-                    response = requests.get(f"http://{camera}{CHECK_EXTENSION}")
-                    if response.status_code == 200:
-                        folder_path = os.path.join(SNAPSHOT_DIR, camera, self.session_start_time)
-                        os.makedirs(folder_path, exist_ok=True)
-                        with open(os.path.join(folder_path, f"image_{int(time.time())}.jpeg"), 'wb') as f:
-                            f.write(response.content)
-            time.sleep(frequency)
-
-    def stop_capture(self):
-        self.capturing.clear()
-
+    def stop_capture(self, stop_schedule=False):
         # Clear the recording label
         self.recording_label.config(text="")
         
         # Only update the button states if schedule is not running
         if not hasattr(self, 'is_schedule_running') or not self.is_schedule_running:
-            self.start_button.config(state=tk.NORMAL, bg="green")
             self.stop_button.config(state=tk.DISABLED)
 
-        # Indicate that the recording was stopped manually
-        self.manual_stop = True
-        
-        # Only update the schedule status if the scheduler is running
-        if hasattr(self, 'is_schedule_running') and self.is_schedule_running:
-            self.schedule_status_var.set("Recording will resume at the next scheduled time")
-            self.schedule_status_label.config(foreground="black", font=("Arial", 10))
-        
-        # Call the convert_images function here
-        for camera, var in self.camera_vars.items():
-            if var.get():
-                folder_path = os.path.join(SNAPSHOT_DIR, camera, self.session_start_time)
-                self.convert_images(folder_path, camera)
+        # Stops capturing and makes the videos, off the Tk thread so the window keeps responding while they encode.
+        # Start stays greyed out until that's done, a new capture would just wait on the engine anyway
+        self.start_button.config(state=tk.DISABLED, bg="grey")
+        self.stopping_thread = Thread(target=self.stop_engine, args=(stop_schedule,), daemon=True)
+        self.stopping_thread.start()
 
         # Reset the blinking state and set the label to its original color
         self.blinking_state = False
         self.schedule_status_label.config(foreground="black")
+        if hasattr(self, 'blink_id'):  # Stop blinking
+            self.after_cancel(self.blink_id)
+        self.schedule_status_var.set("Finishing videos...")
+        self.after(200, self.finish_stop_capture)
+
+    def stop_engine(self, stop_schedule):
+        # Runs on the stopping thread
+        if stop_schedule:
+            self.engine.stop_schedule()
+        self.engine.stop_capture()
+
+    def finish_stop_capture(self):
+        if self.stopping_thread.is_alive():
+            self.after(200, self.finish_stop_capture)
+            return
 
         # Re-enable the user input widgets
         self.set_widget_states(tk.NORMAL)
         self.schedule_button.config(state="normal", bg="yellow")
+        if not self.is_schedule_running:
+            self.start_button.config(state=tk.NORMAL, bg="green")
 
         # Clear the schedule status label
         self.schedule_status_var.set("")
         self.schedule_status_label.config(foreground="black", font=("Arial", 10))
-        if hasattr(self, 'blink_id'):  # Stop blinking
-            self.after_cancel(self.blink_id)
-    
-    def convert_images(self, folder, camera_ip):
-        framerate = self.video_framerate.get() or '24'  # default to 24fps if not provided
-        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-        output_filename = f"TIMELAPSE_{camera_ip}_{timestamp}.mp4"
-
-    # Listing all jpeg files in the folder
-        image_files = [f for f in os.listdir(folder) if f.endswith('.jpeg')]
-        image_files.sort()  # To ensure they are in the order of capture
-
-    # Writing filenames to a temporary txt file
-        filelist_path = os.path.join(folder, "filelist.txt")
-        with open(filelist_path, 'w') as file:
-            for image_file in image_files:
-                file.write(f"file '{image_file}'\n")
-
-    # Using FFmpeg's concat demuxer to read the files from the txt file
-        command = [
-            ffmpeg_path,
-            '-f', 'concat',
-            '-safe', '0',
-              '-i', filelist_path,
-            '-framerate', framerate,
-            '-c:v', 'libx264',
-            '-pix_fmt', 'yuv420p',
-            os.path.join(folder, output_filename)
-        ]
-        subprocess.run(command)
-
-    # Deleting the temporary txt file
-        os.remove(filelist_path)
 
+    def update_conversions(self, lines):
+        # Mirror the conversion queue into the list, only if something's changed
+        if lines != list(self.conversion_list.get(0, tk.END)):
+            self.conversion_list.delete(0, tk.END)
+            for line in lines:
+                self.conversion_list.insert(tk.END, line)
+    
     def convert_existing_images(self):
         # Prompt the user to select a directory
         folder_path = filedialog.askdirectory(title="Select Folder Containing Snapshots")
@@ -662,13 +738,46 @@ class CameraApp(tk.Tk):
         if not folder_path:  # User cancelled the directory selection
             return
         
-        # Assuming all cameras save in the same session folder
-        # Just taking the first camera as reference for now
-        camera_ip = self.cameras[0] if self.cameras else "Unknown_Camera"
-        
-        # Convert the images to a timelapse video
-        self.convert_images(folder_path, camera_ip)
+        # Queue the conversions up, they run in the background and show up in the list below the button.
+        # Finding the sessions in a big snapshots folder takes a while, so that's off the Tk thread too.
+        framerate = self.video_framerate.get() or '24'
+        Thread(target=self.queue_conversions, args=(folder_path, framerate, self.deflicker_var.get()), daemon=True).start()
+
+    def queue_conversions(self, folder_path, framerate, deflicker):
+        if is_session_folder(folder_path):
+            # Snapshots live in SNAPSHOT_DIR/<camera>/<session>, so the parent folder is the camera
+            camera_ip = os.path.basename(os.path.dirname(os.path.abspath(folder_path))) or "Unknown_Camera"
+            self.engine.conversions.submit(folder_path, camera_ip, framerate, deflicker=deflicker)
+        elif not self.engine.conversions.submit_tree(folder_path, framerate, deflicker=deflicker):
+            print(f"Nothing left to convert in {folder_path}")
+
+    def preview_existing_images(self):
+        folder_path = filedialog.askdirectory(title="Select a Session Folder to Preview", initialdir=SNAPSHOT_DIR)
+        if not folder_path:
+            return
+        if not is_session_folder(folder_path):
+            print(f"No snapshots found in {folder_path}")
+            return
+        framerate = self.video_framerate.get() or '24'
+        Thread(target=self.run_preview, args=(folder_path, framerate, self.deflicker_var.get()), daemon=True).start()
+
+    def run_preview(self, folder_path, framerate, deflicker):
+        # Runs on its own thread and never touches tkinter, the full encode shows up in the conversions list
+        preview_path, sheet_path = preview_session(folder_path, framerate)
+        for path in (sheet_path, preview_path):
+            if path:
+                webbrowser.open(Path(path).resolve().as_uri())
+        camera_ip = os.path.basename(os.path.dirname(os.path.abspath(folder_path))) or "Unknown_Camera"
+        # Nothing to gain encoding a session that's still being recorded, stopping it makes the video anyway
+        if os.path.abspath(folder_path) not in {os.path.abspath(folder) for folder in self.engine.active_folders()}:
+            self.engine.conversions.submit(folder_path, camera_ip, framerate, low_priority=True, deflicker=deflicker)
 
 if __name__ == "__main__":
+    try:
+        get_ffmpeg_path()
+    except FFmpegNotFoundError as exc:
+        print(f"Error: {exc}")
+        exit(1)  # This will halt the programme
+    start_metrics(METRICS_PORT, METRICS_LOG, METRICS_HOST)
     app = CameraApp()
     app.mainloop()
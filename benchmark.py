@@ -0,0 +1,347 @@
+# Benchmarks for timelapse_engine, run against local stand-in cameras instead of real ones.
+# Every stand-in serves /snap.jpeg with whatever latency, jitter, payload size and failure rate you ask for,
+# and the results come out as JSON so runs can be compared with each other:
+#   python benchmark.py --cameras 40 --latency 0.05 --jitter 0.02 --payload-kb 500 --output before.json
+#   python benchmark.py --cameras 40 --latency 0.05 --jitter 0.02 --payload-kb 500 --compare before.json
+#   python benchmark.py --cameras 400 --shards 4 --kill-shard --skip-discovery
+
+import argparse
+import base64
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Thread, Event
+
+import timelapse_engine
+from timelapse_engine import (
+    CameraScheduler,
+    CaptureEngine,
+    FFmpegNotFoundError,
+    TimelapseEngine,
+    discover_cameras,
+    get_ffmpeg_path,
+    open_frame_store,
+    percentile,
+)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# A 16x16 grey JPEG, used when Pillow isn't around to draw a proper frame
+TINY_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1x"
+    "eXBkeFxlZ2P/wAALCAAQABABAREA/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQR"
+    "BRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4"
+    "eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/9oACAEB"
+    "AAA/ACiiiv/Z"
+)
+
+def make_jpeg(size_bytes, resolution=(640, 360)):
+    # A valid JPEG padded out to roughly size_bytes with comment (COM) segments, which decoders skip
+    if Image is not None:
+        buffer = BytesIO()
+        Image.linear_gradient('L').resize(resolution).convert('RGB').save(buffer, 'JPEG', quality=85)
+        base = buffer.getvalue()
+    else:
+        base = TINY_JPEG
+
+    padding = bytearray()
+    remaining = size_bytes - len(base)
+    while remaining > 4:
+        chunk = min(remaining - 4, 65533)
+        padding += b'\xff\xfe' + (chunk + 2).to_bytes(2, 'big') + os.urandom(chunk)
+        remaining -= chunk + 4
+    # COM segments go straight after the SOI marker
+    return base[:2] + bytes(padding) + base[2:]
+
+class FakeCameraHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_snapshot(head=True)
+
+    def do_GET(self):
+        self.send_snapshot(head=False)
+
+    def send_snapshot(self, head):
+        camera = self.server.camera
+        if self.path != timelapse_engine.CHECK_EXTENSION:
+            self.send_error(404)
+            return
+        time.sleep(max(0.0, random.gauss(camera.latency, camera.jitter)))
+
+        failing = not head and random.random() < camera.failure_rate
+        if failing and random.random() < 0.5:
+            self.send_error(503)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(camera.payload)))
+        self.end_headers()
+        if head:
+            return
+        if failing:
+            # The other way cameras fail: hang up halfway through the JPEG
+            self.wfile.write(camera.payload[:len(camera.payload) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(camera.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeCamera:
+    # One stand-in UniFi camera on host:port
+    def __init__(self, host, port, payload, latency=0.05, jitter=0.01, failure_rate=0.0):
+        self.payload = payload
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.server = ThreadingHTTPServer((host, port), FakeCameraHandler)
+        self.server.daemon_threads = True
+        self.server.camera = self
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return host if port == 80 else f"{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def start_fake_cameras(count, port, payload, latency, jitter, failure_rate):
+    # Each camera gets its own loopback address (127.0.0.2, .3, ...) so discovery can sweep them like a real subnet.
+    # Platforms that only route 127.0.0.1 get one address with a port per camera instead, and no discovery run.
+    try:
+        return [FakeCamera(f"127.0.{(i + 2) // 256}.{(i + 2) % 256}", port, payload, latency, jitter, failure_rate).start()
+                for i in range(count)], True
+    except OSError:
+        return [FakeCamera('127.0.0.1', 0, payload, latency, jitter, failure_rate).start() for _ in range(count)], False
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def bench_discovery(count, port):
+    prefix = 24 if count < 254 else 22
+    started = time.monotonic()
+    found = discover_cameras(ip_range=f"127.0.0.0/{prefix}", port=port, use_cache=False)
+    return {
+        'ip_range': f"127.0.0.0/{prefix}",
+        'cameras_found': len(found),
+        'wall_time_s': round(time.monotonic() - started, 3),
+    }
+
+def bench_capture(cameras, ticks, interval, spread=False, storage='files'):
+    session = 'benchmark'
+    manifests = {camera: open_frame_store(os.path.join(timelapse_engine.SNAPSHOT_DIR, camera, session), storage)
+                 for camera in cameras}
+    engine = CaptureEngine(cameras, session, manifests=manifests)
+    scheduler = CameraScheduler(cameras, interval, spread=spread)
+    never = Event()
+    reports = []
+    started = time.monotonic()
+    # Same number of snapshots either way, spread out they just arrive a camera or two at a time
+    snapshots = 0
+    while snapshots < ticks * len(cameras):
+        lateness, batch = scheduler.wait(never)
+        if spread:
+            # Like the engine, spread batches are handed off without waiting for them to come back
+            engine.submit_tick(batch, lambda report, lateness=lateness: reports.append(dict(report, lateness=lateness)))
+        else:
+            report = engine.capture_tick(batch)
+            report['lateness'] = lateness
+            reports.append(report)
+        snapshots += len(batch)
+    engine.close()
+    wall_time = time.monotonic() - started
+    for manifest in manifests.values():
+        manifest.close()
+
+    frames = sum(manifest.count for manifest in manifests.values())
+    skews = [report['skew'] for report in reports]
+    durations = [report['duration'] for report in reports]
+    lateness = [report['lateness'] for report in reports]
+    return {
+        'ticks': ticks,
+        'frames': frames,
+        'failed_fetches': sum(len(report['failed']) for report in reports),
+        'frames_per_second': round(frames / wall_time, 2),
+        'megabytes_per_second': round(sum(m.total_bytes for m in manifests.values()) / wall_time / (1024 * 1024), 2),
+        'tick_skew_p50_ms': round(percentile(skews, 50) * 1000, 1),
+        'tick_skew_p99_ms': round(percentile(skews, 99) * 1000, 1),
+        'tick_duration_p50_ms': round(percentile(durations, 50) * 1000, 1),
+        'tick_duration_p99_ms': round(percentile(durations, 99) * 1000, 1),
+        'tick_lateness_p50_ms': round(percentile(lateness, 50) * 1000, 1),
+        'tick_lateness_p99_ms': round(percentile(lateness, 99) * 1000, 1),
+    }, manifests
+
+def bench_sharded_capture(cameras, ticks, interval, spread, storage, shards, kill_shard=False):
+    # The same snapshots through TimelapseEngine with the cameras split across shard processes.
+    # kill_shard kills shard 0 halfway through, to see the coordinator restart it.
+    engine = TimelapseEngine()
+    started = time.monotonic()
+    engine.start_capture(cameras, frequency=interval, spread=spread, storage=storage, shards=shards)
+    coordinator = engine.coordinator
+    target = ticks * len(cameras)
+    # Time for the restart backoff on top, if we're killing one
+    deadline = started + ticks * interval * 2 + (timelapse_engine.SHARD_RESTART_DELAY if kill_shard else 0) + 30
+    killed = False
+    while engine.status()['captures'] < target and time.monotonic() < deadline:
+        if kill_shard and not killed and engine.status()['captures'] >= target // 2:
+            coordinator.processes[0].kill()
+            killed = True
+        time.sleep(0.2)
+    totals = engine.halt_capture()
+    engine.journal.stop_capture(totals)
+    engine.retention.stop()
+    wall_time = time.monotonic() - started
+
+    frames = sum(entry['frames'] for entry in totals.values())
+    manifests = {camera: open_frame_store(os.path.join(timelapse_engine.SNAPSHOT_DIR, camera, engine.session_name))
+                 for camera in cameras}
+    return {
+        'ticks': ticks,
+        'shards': len(coordinator.shards),
+        'frames': frames,
+        'frames_per_second': round(frames / wall_time, 2),
+        'megabytes_per_second': round(sum(entry['bytes'] for entry in totals.values()) / wall_time / (1024 * 1024), 2),
+        'per_shard': [{
+            'cameras': len(shard_cameras),
+            'frames': sum(totals.get(camera, {}).get('frames', 0) for camera in shard_cameras),
+            'restarts': coordinator.restarts[index],
+        } for index, shard_cameras in enumerate(coordinator.shards)],
+    }, manifests
+
+def bench_encode(manifest, framerate):
+    try:
+        get_ffmpeg_path()
+    except FFmpegNotFoundError as exc:
+        return {'skipped': str(exc)}
+    if manifest.count == 0:
+        return {'skipped': "no frames were captured"}
+
+    started = time.monotonic()
+    ok = TimelapseEngine().convert_folder(manifest.folder, 'benchmark', framerate)
+    wall_time = time.monotonic() - started
+    return {
+        'frames': manifest.count,
+        'succeeded': ok,
+        'wall_time_s': round(wall_time, 3),
+        'encode_fps': round(manifest.count / wall_time, 1),
+    }
+
+def compare(previous, current, prefix=''):
+    # Prints every numeric metric that exists in both runs, with the change
+    for key, value in current.items():
+        old = previous.get(key) if isinstance(previous, dict) else None
+        if isinstance(value, dict):
+            compare(old or {}, value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(old, (int, float)):
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{prefix}{key}: {old} -> {value} ({change})", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark discovery, capture and encoding against fake cameras.")
+    parser.add_argument('--cameras', type=int, default=20, help="number of fake cameras (default: 20)")
+    parser.add_argument('--port', type=int, default=18080, help="port the fake cameras listen on (default: 18080)")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean snapshot latency in seconds (default: 0.05)")
+    parser.add_argument('--jitter', type=float, default=0.01, help="standard deviation of the latency (default: 0.01)")
+    parser.add_argument('--payload-kb', type=int, default=500, help="snapshot size in KB (default: 500)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of snapshots that fail (default: 0)")
+    parser.add_argument('--ticks', type=int, default=20, help="capture ticks to run (default: 20)")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between ticks (default: 1)")
+    parser.add_argument('--fps', type=int, default=24, help="frame rate for the encode benchmark (default: 24)")
+    parser.add_argument('--spread', action='store_true', help="stagger the cameras across the interval")
+    parser.add_argument('--storage', choices=('files', 'container'), default='files', help="how frames are stored")
+    parser.add_argument('--shards', type=int, default=1, help="capture through TimelapseEngine split across this many processes")
+    parser.add_argument('--kill-shard', action='store_true', help="with --shards, kill one halfway through to test restarts")
+    parser.add_argument('--skip-discovery', action='store_true')
+    parser.add_argument('--skip-encode', action='store_true')
+    parser.add_argument('--output', help="write the JSON results here as well as to stdout")
+    parser.add_argument('--compare', help="a previous results file to compare against")
+    args = parser.parse_args(argv)
+    if args.interval < timelapse_engine.MIN_FRAME_SPACING:
+        # Frames are named by the second they were taken, anything faster would just overwrite itself
+        parser.error(f"--interval must be at least {timelapse_engine.MIN_FRAME_SPACING:g} second")
+
+    payload = make_jpeg(args.payload_kb * 1024)
+    cameras, own_addresses = start_fake_cameras(args.cameras, args.port, payload, args.latency, args.jitter,
+                                                args.failure_rate)
+    snapshot_dir = tempfile.mkdtemp(prefix='timelapse-bench-')
+    timelapse_engine.SNAPSHOT_DIR = snapshot_dir
+    timelapse_engine.render_cache.budget = 0  # Measure real encodes, and keep benchmark videos out of the cache
+    timelapse_engine.estimator.path = os.path.join(snapshot_dir, 'estimates.json')  # Fake cameras aren't worth remembering
+    results = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+    }
+
+    # Keep the engine's chatter off stdout so the JSON is the only thing there. Shard processes write straight
+    # to file descriptor 1, so that's pointed at stderr for the run as well.
+    sys.stdout.flush()
+    stdout_fd = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.skip_discovery or not own_addresses:
+                results['discovery'] = {'skipped': "disabled" if args.skip_discovery else "needs one loopback address per camera"}
+            else:
+                results['discovery'] = bench_discovery(args.cameras, args.port)
+            addresses = [camera.address for camera in cameras]
+            if args.shards > 1:
+                results['capture'], manifests = bench_sharded_capture(addresses, args.ticks, args.interval, args.spread,
+                                                                      args.storage, args.shards, args.kill_shard)
+            else:
+                results['capture'], manifests = bench_capture(addresses, args.ticks, args.interval, args.spread, args.storage)
+            if args.skip_encode:
+                results['encode'] = {'skipped': "disabled"}
+            else:
+                results['encode'] = bench_encode(next(iter(manifests.values())), args.fps)
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        os.dup2(stdout_fd, 1)
+        os.close(stdout_fd)
+        for camera in cameras:
+            camera.stop()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare(json.load(file), results)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,3520 @@
+# The capture, schedule and encode side of UniFi Camera Timelapse Creator, with no tkinter in sight.
+# UnifiCameraTimelapse.py is the GUI on top of this; run this file directly for a headless capture:
+#   python timelapse_engine.py capture --camera 192.168.1.5 --interval 10 --schedule mon-fri@08:00-17:00
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait as wait_futures
+from ipaddress import IPv4Network, IPv4Interface
+import os
+import shutil
+import subprocess
+import time
+from threading import Thread, Event, Lock, Semaphore
+from collections import deque
+from datetime import datetime, timedelta
+from queue import Queue, Empty
+import requests
+import socket
+import json
+import asyncio
+import hashlib
+import traceback
+import argparse
+import signal
+import heapq
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+import mmap
+import struct
+from io import BytesIO
+from timelapse_metrics import metrics, start_metrics
+
+# Pillow is optional, without it duplicate detection can only spot byte-for-byte identical frames
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# NumPy is optional too, it's only needed (along with Pillow) to deflicker. It takes a while to import,
+# so that waits until deflicker_available() is first asked.
+np = None
+
+# Configuration
+IP_FILE = './IP.txt'
+IP_RANGE_FILE = './IP_range.txt'
+SNAPSHOT_DIR = './snapshots/'
+CHECK_EXTENSION = "/snap.jpeg"
+CAMERA_PORT = 80
+CAMERA_CACHE_FILE = './camera_cache.json'
+CAMERA_CACHE_TTL = 24 * 3600  # Seconds before a cached discovery is considered stale and the network is swept again
+DISCOVERY_CONCURRENCY = 256  # Simultaneous TCP connection attempts during the sweep
+PROBE_TIMEOUT = 0.5  # Seconds to wait for a host to accept a TCP connection
+MAX_CAPTURE_WORKERS = 32  # Upper bound on simultaneous snapshot downloads per tick
+CATCH_UP_POLICY = 'skip'  # 'skip' drops ticks we fell too far behind on, 'catch_up' runs them back to back
+MIN_FRAME_SPACING = 1.0  # Frames are named by the whole second they were taken, so never fetch a camera more often than this
+LATENESS_REPORT_TICKS = 60  # Print a tick lateness summary every this many ticks
+DEFAULT_FETCH_TIMEOUT = 5.0  # Seconds allowed for a snapshot before we've measured how fast a camera is
+MIN_FETCH_TIMEOUT = 2.0
+MAX_FETCH_TIMEOUT = 15.0
+TIMEOUT_LATENCY_FACTOR = 4  # Timeout is this many times the camera's typical latency, clamped to the limits above
+CIRCUIT_FAILURE_THRESHOLD = 3  # Consecutive failures before a camera is taken out of the tick
+BACKOFF_BASE = 5.0  # Seconds before the first background re-probe of a dead camera, doubling each failed probe
+BACKOFF_MAX = 300.0
+MAX_FRAME_BYTES = 16 * 1024 * 1024  # Snapshots bigger than this are rejected rather than buffered
+FRAME_POOL_SIZE = 64  # Most frames held in memory at once across fetchers, the disk writer and encoders
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+STREAM_QUEUE_SIZE = 120  # Frames buffered per camera when streaming into ffmpeg before capture waits on it
+SEGMENT_FRAMES = 1000  # Frames per incrementally encoded chunk
+SEGMENT_INDEX = 'segments.json'  # Lives in each session folder, records which chunks are already encoded
+STATUS_INTERVAL = 1.0  # Seconds between the 'status' events subscribers get, see TimelapseEngine.subscribe
+JOURNAL_SUFFIX = '.journal'  # Each session's SessionJournal is SNAPSHOT_DIR/<session><suffix> until its videos are done
+JOURNAL_INTERVAL = 60  # Seconds between frame count checkpoints in the journal
+CAPTURE_SHARDS = 1  # Worker processes the cameras are split across while capturing, for fleets too big for one process
+SHARD_REPORT_INTERVAL = 1.0  # Seconds between each shard's progress reports to the coordinator
+SHARD_RESTART_DELAY = 5.0  # Seconds before a crashed shard is started again, doubling each time it crashes soon after starting
+SHARD_RESTART_MAX = 300.0
+SHARD_STARTUP_TIMEOUT = 60.0  # Seconds to wait for every shard to start before the session clock starts anyway
+SHARD_STOP_TIMEOUT = 300.0  # Seconds a shard gets to finish its last tick and chunk encode when capture stops
+CONVERT_JOBS = None  # Conversions run side by side, None picks a number from the CPU count
+RENDER_CACHE_DIR = './render_cache/'  # Finished videos and chunks, keyed on a hash of their frames and encode settings
+RENDER_CACHE_BUDGET = 10 * 1024 ** 3  # Bytes of renders to keep before the least recently used go, None for no limit, 0 turns the cache off
+VIDEO_OPTIONS = ('-c:v', 'libx264', '-pix_fmt', 'yuv420p')  # Part of every render's cache key, so changing them never reuses a stale video
+DEFLICKER_WINDOW = 25  # Frames each frame's brightness is averaged over (centred on it) when deflickering
+DEFLICKER_MAX_GAIN = 2.0  # Furthest deflicker will brighten or darken a frame, as a multiplier
+DEFLICKER_QUALITY = 92  # JPEG quality of corrected frames on their way into ffmpeg
+DEFLICKER_STATS = 'luminance.json'  # Lives in each session folder, per-frame brightness so re-renders skip the analysis
+THUMBNAIL_DIR = 'thumbnails'  # Lives in each session folder once a preview has been made, one small JPEG per frame
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_QUALITY = 70
+PREVIEW_FILE = 'preview.mp4'  # Written to the session folder
+PREVIEW_OPTIONS = ('-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '30', '-pix_fmt', 'yuv420p')
+CONTACT_SHEET_FILE = 'contact_sheet.jpeg'  # Written to the session folder, frames spread evenly over the session
+CONTACT_SHEET_COLUMNS = 6
+CONTACT_SHEET_ROWS = 6
+DEDUP_THRESHOLD = 0.02  # Mean per-pixel difference (0-1) below which a frame counts as a duplicate of the last kept one
+DEDUP_KEEP_EVERY = 30  # Always keep at least every Nth frame, even if nothing has changed
+WRITE_QUEUE_SIZE = 256  # Frames waiting for the disk writer before fetchers have to wait
+FSYNC_BATCH = 32  # Frames written to temp files before they're fsynced and renamed into place together
+FSYNC_INTERVAL = 2.0  # ...or seconds, whichever comes first
+MANIFEST_FILE = 'frames.csv'  # Lives in each session folder, one "filename,bytes,timestamp" line per frame
+FRAME_STORAGE = 'files'  # 'files' writes one JPEG per frame, 'container' appends every frame to one file per session
+CONTAINER_FILE = 'frames.bin'  # The JPEGs back to back, with 'container' storage
+CONTAINER_INDEX = 'frames.idx'  # One fixed-size (offset, length, timestamp) record per frame in CONTAINER_FILE
+INDEX_RECORD = struct.Struct('<QId')
+RETENTION_CAMERA_BUDGET = None  # Most bytes of snapshots and videos to keep per camera, None for no limit
+RETENTION_TOTAL_BUDGET = None  # Most bytes to keep in SNAPSHOT_DIR across every camera, None for no limit
+THINNING_RULES = ()  # (days, n) pairs: sessions older than days keep only every nth frame, e.g. ((7, 2), (30, 4))
+DELETE_ENCODED_AFTER_DAYS = None  # Delete the frames (not the video) of encoded sessions after this many days
+MAX_THINNING = 64  # Budgets thin a session down to every this-many frames before deleting it outright
+RETENTION_INTERVAL = 900  # Seconds between retention passes
+RETENTION_PAUSE = 0.01  # Seconds retention sleeps after each file it deletes, so it never competes with capture for the disk
+RETENTION_STATE = 'retention.json'  # Lives in each session folder, records how far it's been thinned
+ENCODED_MARKER = 'encoded.json'  # Written to a session folder once its video is complete, with how many frames went in
+DISK_FULL_WARNING = 24 * 3600  # Warn when the disk is forecast to fill up within this many seconds
+SCHEDULE_RESYNC_INTERVAL = 300  # Longest the schedule sleeps before re-reading the wall clock, in case it's been changed
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+ESTIMATES_FILE = './estimates.json'  # Rolling per-camera frame size, fetch time and encode speed, measured as we go
+ESTIMATE_WEIGHT = 0.02  # How far each new measurement moves a rolling average, once it has a few samples
+DEFAULT_FRAME_KB = 500  # Assumed for cameras nothing has been measured for yet
+DEFAULT_FETCH_SECONDS = 0.5
+DEFAULT_ENCODE_FPS = 60
+METRICS_PORT = None  # Serve Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, None to leave it off
+METRICS_HOST = '127.0.0.1'  # Only this machine can scrape by default, '0.0.0.0' lets Prometheus on another box in
+METRICS_LOG = None  # Append one JSON line per tick, failure and encode to this file, None to leave it off
+FFMPEG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ffmpeg.exe' if os.name == 'nt' else 'ffmpeg')
+
+def calculate_timelapse_data(frequency, frame_rate, avg_size_kb=None, cameras=None):
+    # Frames, MB and seconds of footage per camera per hour. The frame size is measured (see Estimator) unless given.
+    if avg_size_kb is None:
+        avg_size_kb = estimator.average('frame_bytes', cameras) / 1024
+    frames_per_hour = 3600 / frequency
+    filesize_per_hour_mb = (frames_per_hour * avg_size_kb) / 1024
+    footage_duration_seconds = frames_per_hour / frame_rate
+
+    return int(frames_per_hour), int(filesize_per_hour_mb), int(footage_duration_seconds)
+
+class Estimator:
+    # Rolling per-camera averages of frame size, fetch time and encode speed, taken from real captures and encodes
+    # and kept in ESTIMATES_FILE between runs. A camera we haven't measured yet borrows the average of the ones we
+    # have, and failing that the defaults at the top of this file.
+    DEFAULTS = {
+        'frame_bytes': DEFAULT_FRAME_KB * 1024,
+        'fetch_seconds': DEFAULT_FETCH_SECONDS,
+        'encode_fps': DEFAULT_ENCODE_FPS,
+    }
+    SAVE_INTERVAL = 60  # Seconds between saves while measurements are coming in
+
+    def __init__(self, path=ESTIMATES_FILE):
+        self.path = path
+        self.lock = Lock()
+        self.cameras = None  # camera -> {field: [average, samples]}, read on first use
+        self.dirty = False
+        self.readonly = False  # Capture shards measure but leave saving to the coordinator, see ShardCoordinator
+        self.last_saved = time.monotonic()
+
+    def load(self):
+        if self.cameras is not None:
+            return
+        self.cameras = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as file:
+                    self.cameras = json.load(file)
+            except (OSError, ValueError):
+                print(f"Couldn't read {self.path}, estimates start from scratch.")
+
+    def _update(self, camera, field, value):
+        stats = self.cameras.setdefault(camera, {})
+        average, samples = stats.get(field, (0.0, 0))
+        samples += 1
+        # A plain mean until there are enough samples, then an exponential moving average so it follows changes
+        stats[field] = [average + (value - average) * max(ESTIMATE_WEIGHT, 1 / samples), samples]
+        self.dirty = True
+
+    def record_fetch(self, camera, size, seconds):
+        with self.lock:
+            self.load()
+            self._update(camera, 'frame_bytes', size)
+            self._update(camera, 'fetch_seconds', seconds)
+        if time.monotonic() - self.last_saved > self.SAVE_INTERVAL:
+            self.save()
+
+    def record_encode(self, camera, frames, seconds):
+        if not frames or seconds <= 0:
+            return
+        with self.lock:
+            self.load()
+            self._update(camera, 'encode_fps', frames / seconds)
+        self.save()
+
+    def snapshot(self, cameras):
+        # Just these cameras' stats, to hand to another process's merge()
+        with self.lock:
+            self.load()
+            return {camera: dict(self.cameras[camera]) for camera in cameras if camera in self.cameras}
+
+    def merge(self, cameras):
+        # Takes another process's measurements as the latest for those cameras
+        if not cameras:
+            return
+        with self.lock:
+            self.load()
+            self.cameras.update(cameras)
+            self.dirty = True
+        if time.monotonic() - self.last_saved > self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or self.readonly:
+                return
+            self.dirty = False
+            self.last_saved = time.monotonic()
+            try:
+                with open(self.path + '.tmp', 'w') as file:
+                    json.dump(self.cameras, file, indent=1)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as exc:
+                print(f"Couldn't save {self.path}: {exc}")
+
+    def get(self, camera, field):
+        with self.lock:
+            self.load()
+            stats = self.cameras.get(camera, {}).get(field)
+            if stats:
+                return stats[0]
+            measured = [camera_stats[field][0] for camera_stats in self.cameras.values() if field in camera_stats]
+        return sum(measured) / len(measured) if measured else self.DEFAULTS[field]
+
+    def measured(self, camera):
+        with self.lock:
+            self.load()
+            return camera in self.cameras
+
+    def average(self, field, cameras=None):
+        # Across the given cameras, or everything measured so far without them
+        if not cameras:
+            return self.get(None, field)
+        return sum(self.get(camera, field) for camera in cameras) / len(cameras)
+
+    def estimate(self, cameras, frequency, frame_rate):
+        # What capturing these cameras every frequency seconds would take, per hour of capture
+        frames_per_hour = 3600 / frequency
+        latencies = [self.get(camera, 'fetch_seconds') for camera in cameras] or [0.0]
+        # Fetches run side by side (up to MAX_CAPTURE_WORKERS), so a tick takes about as long as the slowest camera,
+        # unless there are so many cameras the workers have to take turns. Frames are named by the second, hence 1s.
+        tick_seconds = max(max(latencies), sum(latencies) / max(1, min(len(cameras), MAX_CAPTURE_WORKERS)))
+        bytes_per_hour = sum(self.get(camera, 'frame_bytes') for camera in cameras) * frames_per_hour
+        return {
+            'cameras': len(cameras),
+            'measured': sum(1 for camera in cameras if self.measured(camera)),
+            'frames_per_hour': frames_per_hour * len(cameras),
+            'bytes_per_hour': bytes_per_hour,
+            'bandwidth': bytes_per_hour / 3600,  # bytes/s
+            'footage_seconds_per_hour': frames_per_hour / frame_rate,
+            'min_interval': max(1.0, tick_seconds),
+            'encode_seconds_per_hour': sum(frames_per_hour / self.get(camera, 'encode_fps') for camera in cameras),
+        }
+
+# Shared by capture, encoding and whatever's showing estimates
+estimator = Estimator()
+
+def describe_estimate(estimate):
+    # One line for the GUI and the estimate command
+    if not estimate['cameras']:
+        return "Select cameras to see what they'll need."
+    text = (f"{estimate['cameras']} camera{'s' if estimate['cameras'] != 1 else ''}: {estimate['bytes_per_hour'] * 24 / 1024 ** 3:.1f} GB/day, "
+            f"{estimate['bandwidth'] * 8 / 1e6:.1f} Mbit/s, "
+            f"~{estimate['encode_seconds_per_hour'] / 60:.0f} min to encode each hour, "
+            f"fastest interval {estimate['min_interval']:.1f}s")
+    if estimate['measured'] < estimate['cameras']:
+        text += f" ({estimate['cameras'] - estimate['measured']} not measured yet)"
+    return text
+
+class FFmpegNotFoundError(Exception):
+    pass
+
+def is_ffmpeg_installed():
+    # Check if there's an ffmpeg on the PATH that is NOT the one in the local directory
+    system_ffmpeg = shutil.which("ffmpeg")
+    return system_ffmpeg is not None and os.path.dirname(os.path.abspath(system_ffmpeg)) != os.path.dirname(os.path.abspath(__file__))
+
+_ffmpeg_path = None
+
+def get_ffmpeg_path():
+    # Resolved the first time something actually needs to encode, so starting up never waits on it
+    global _ffmpeg_path
+    if _ffmpeg_path is None:
+        if is_ffmpeg_installed():
+            print("Using system-wide installation of FFMpeg.")
+            _ffmpeg_path = "ffmpeg"
+        elif os.path.exists(FFMPEG_PATH):
+            print(f"Using local FFMpeg executable at {FFMPEG_PATH}.")
+            _ffmpeg_path = FFMPEG_PATH
+        else:
+            raise FFmpegNotFoundError("FFMpeg not found! Please ensure FFMpeg is either installed system-wide "
+                                      "or the ffmpeg executable is present in the script directory.")
+    return _ffmpeg_path
+
+def get_default_ip_range():
+    # Get the IP address of the machine
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Doesn't have to be reachable, it's just to get the IP address bound to a network interface
+        s.connect(('10.254.254.254', 1))
+        ip_address = s.getsockname()[0]
+    except Exception:
+        ip_address = '127.0.0.1'
+    finally:
+        s.close()
+
+    # Assuming a /24 subnet for simplicity
+    subnet = IPv4Interface(f'{ip_address}/24').network
+    return str(subnet)
+
+def read_ip_range():
+    # Check if IP_range.txt exists and read the first line for the IP range
+    ip_range = get_default_ip_range()
+    if os.path.exists(IP_RANGE_FILE):
+        with open(IP_RANGE_FILE, "r") as file:
+            custom_ip_range = file.readline().strip()
+            if custom_ip_range:
+                ip_range = custom_ip_range
+                print(f"Using IP range from IP_range.txt: {ip_range}")
+            else:
+                print(f"IP_range.txt is empty. Using detected IP range: {ip_range}")
+    else:
+        print(f"IP_range.txt not found. Using detected IP range: {ip_range}")
+    return ip_range
+
+def load_camera_cache(ip_range, port=None):
+    # Cameras found by a previous discovery of the same range and port, as long as it isn't older than CAMERA_CACHE_TTL
+    try:
+        with open(CAMERA_CACHE_FILE, 'r') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get('ip_range') != ip_range or cache.get('port', CAMERA_PORT) != (port or CAMERA_PORT):
+        return None
+    if time.time() - cache.get('timestamp', 0) > CAMERA_CACHE_TTL:
+        return None
+    return cache.get('cameras') or None
+
+def save_camera_cache(ip_range, cameras, port=None):
+    try:
+        with open(CAMERA_CACHE_FILE, 'w') as file:
+            json.dump({'ip_range': ip_range, 'port': port or CAMERA_PORT, 'timestamp': time.time(), 'cameras': cameras},
+                      file, indent=1)
+    except OSError as exc:
+        print(f"Couldn't write camera cache: {exc}")
+
+async def tcp_sweep(hosts, port=None, on_open=None):
+    # Cheap first pass: only hosts that accept a TCP connection get an HTTP request later
+    port = port or CAMERA_PORT
+    semaphore = asyncio.Semaphore(DISCOVERY_CONCURRENCY)
+
+    async def probe(host):
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), PROBE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            writer.close()
+            if on_open:
+                on_open(host)
+            return host
+
+    results = await asyncio.gather(*(probe(host) for host in hosts))
+    return [host for host in results if host]
+
+def camera_sort_key(address):
+    # "192.168.1.5" or "192.168.1.5:8080", sorted numerically
+    host, _, port = address.partition(':')
+    return tuple(int(part) for part in host.split('.')) + (int(port or CAMERA_PORT),)
+
+def discover_cameras(on_found=None, ip_range=None, port=None, use_cache=True):
+    # on_found(camera) is called as each camera turns up, so the GUI can fill in the list while we keep looking.
+    # Passing ip_range (and port) sweeps exactly that, skipping IP.txt and IP_range.txt.
+    def found(camera):
+        if on_found:
+            on_found(camera)
+        return camera
+
+    if ip_range is None:
+        # Try reading from IP.txt first
+        if os.path.exists(IP_FILE) and os.path.getsize(IP_FILE) > 0:
+            with open(IP_FILE, 'r') as file:
+                return [found(line.strip()) for line in file.readlines() if line.strip()]
+        else:
+            print("IP.txt not found, starting network discovery...")
+
+        ip_range = read_ip_range()
+
+    # Reuse the last discovery if it's still fresh
+    cached_cameras = load_camera_cache(ip_range, port) if use_cache else None
+    if cached_cameras:
+        print(f"Using {len(cached_cameras)} cameras from {CAMERA_CACHE_FILE}")
+        return [found(camera) for camera in cached_cameras]
+
+    # Discover cameras on the network using the specified or default IP range.
+    # The TCP sweep hands each open host straight to the HTTP check, so results stream in as they're confirmed.
+    print("Starting camera discovery...")
+    discovery_start = time.monotonic()
+    found_cameras = []
+    found_lock = Lock()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        def checked(future, ip):
+            # Runs as each check finishes, while the sweep is still going, so cameras show up straight away
+            try:
+                result = future.result()
+            except Exception as exc:
+                print(f'{ip} generated an exception: {exc}')
+                return
+            if result:
+                print(f"Discovered camera at {result}")
+                with found_lock:
+                    found_cameras.append(found(result))
+
+        def check_open_host(host):
+            future = executor.submit(check_camera, host, port)
+            future.add_done_callback(lambda future: checked(future, host))
+
+        hosts = [str(ip) for ip in IPv4Network(ip_range, strict=False).hosts()]
+        asyncio.run(tcp_sweep(hosts, port, on_open=check_open_host))
+
+    discovery_time = time.monotonic() - discovery_start
+    metrics.set('timelapse_discovery_seconds', discovery_time)
+    metrics.set('timelapse_discovered_cameras', len(found_cameras))
+    metrics.event('discovery', ip_range=ip_range, cameras=len(found_cameras), seconds=round(discovery_time, 3))
+
+    if use_cache:
+        save_camera_cache(ip_range, sorted(found_cameras, key=camera_sort_key), port)
+    return found_cameras
+
+def check_camera(ip, port=None):
+    # HEAD is enough to see the JPEG content type; fall back to a one-byte ranged GET for cameras that don't do HEAD
+    port = port or CAMERA_PORT
+    address = ip if port == 80 else f"{ip}:{port}"
+    url = f"http://{address}{CHECK_EXTENSION}"
+    try:
+        response = requests.head(url, timeout=1)
+        if response.status_code == 200 and response.headers.get('Content-Type') == 'image/jpeg':
+            return address
+        with requests.get(url, headers={'Range': 'bytes=0-0'}, timeout=1, stream=True) as response:
+            if response.status_code in (200, 206) and response.headers.get('Content-Type') == 'image/jpeg':
+                return address
+    except requests.RequestException:
+        pass
+    return None
+
+def percentile(values, pct):
+    # Nearest-rank percentile, good enough for a handful of timing samples
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def spread_offsets(cameras, intervals, offsets=None):
+    # Gives each group of cameras on the same interval evenly spaced offsets, unless one was set explicitly
+    offsets = dict(offsets or {})
+    groups = {}
+    for camera in cameras:
+        if camera not in offsets:
+            groups.setdefault(intervals[camera], []).append(camera)
+    for group_interval, group in groups.items():
+        for i, camera in enumerate(group):
+            offsets[camera] = i * group_interval / len(group)
+    return offsets
+
+class CameraScheduler:
+    # Per-camera deadlines kept in a heap, so we only wake up when the next camera is due, however many there are.
+    # Each camera has its own interval and phase offset. With spread on, cameras sharing an interval are staggered
+    # evenly across it, so hundreds of cameras become a steady trickle of fetches instead of one burst per tick.
+    # Cameras that fall due at the same moment are handed back together as one batch.
+    # Deadlines are absolute (offset + n * interval on the monotonic clock), so fetch and write time never turns into drift.
+    def __init__(self, cameras, interval, intervals=None, offsets=None, spread=False, policy=CATCH_UP_POLICY,
+                 history=3600, start=None):
+        if policy not in ('skip', 'catch_up'):
+            raise ValueError(f"Unknown catch-up policy: {policy}")
+        self.policy = policy
+        self.spread = spread
+        self.intervals = {camera: float((intervals or {}).get(camera, interval)) for camera in cameras}
+        offsets = spread_offsets(cameras, self.intervals, offsets) if spread else dict(offsets or {})
+
+        # start lets several schedulers (one per capture shard) share one clock origin. time.monotonic() is
+        # system-wide, so it means the same thing in every process on the machine.
+        start = time.monotonic() if start is None else start
+        self.heap = [(start + offsets.get(camera, 0.0), i, camera) for i, camera in enumerate(cameras)]
+        heapq.heapify(self.heap)
+        self.lateness = deque(maxlen=history)  # Seconds each recent batch started after its deadline
+        self.ticks = 0
+        self.skipped = 0
+
+    def wait(self, stop_event):
+        # Blocks until the next camera is due. Returns (lateness, cameras due), or None if stop_event was set.
+        if not self.heap:
+            stop_event.wait()
+            return None
+        remaining = self.heap[0][0] - time.monotonic()
+        if remaining > 0 and stop_event.wait(remaining):
+            return None
+        if stop_event.is_set():
+            return None
+
+        now = time.monotonic()
+        late = now - self.heap[0][0]
+        batch = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, order, camera = heapq.heappop(self.heap)
+            interval = self.intervals[camera]
+            behind = now - deadline
+            if behind >= interval and self.policy == 'skip':
+                # At least a whole interval behind on this camera, jump to its most recent deadline
+                missed = int(behind // interval)
+                self.skipped += missed
+                deadline += missed * interval
+            next_deadline = deadline + interval
+            if next_deadline < now + MIN_FRAME_SPACING:
+                # Catching up back to back (or landing just after a skip) would take two frames in the same second,
+                # and the second one would overwrite the first. Re-anchor the camera's deadlines from here instead.
+                next_deadline = now + max(interval, MIN_FRAME_SPACING)
+            heapq.heappush(self.heap, (next_deadline, order, camera))
+            batch.append(camera)
+
+        self.ticks += 1
+        self.lateness.append(late)
+        return late, batch
+
+    def summary(self):
+        samples = list(self.lateness)
+        return (f"Capture lateness over {self.ticks} batches: p50 {percentile(samples, 50) * 1000:.0f}ms, "
+                f"p99 {percentile(samples, 99) * 1000:.0f}ms, {self.skipped} captures skipped")
+
+class BufferPool:
+    # Download buffers that get reused frame after frame instead of allocating a fresh bytes object per snapshot.
+    # Only max_buffers frames can be in flight at once, so peak memory is bounded no matter how many cameras there are.
+    def __init__(self, max_buffers=FRAME_POOL_SIZE):
+        self.available = Semaphore(max_buffers)
+        self.free = []
+        self.lock = Lock()
+
+    def acquire(self):
+        self.available.acquire()
+        with self.lock:
+            buffer = self.free.pop() if self.free else bytearray()
+        return PooledFrame(self, buffer)
+
+    def release(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
+        self.available.release()
+
+class PooledFrame:
+    # One downloaded snapshot living in a pooled buffer. Each consumer (disk writer, encoder) holds a reference
+    # and the buffer goes back to the pool once the last one is done with it.
+    def __init__(self, pool, buffer):
+        self.pool = pool
+        self.buffer = buffer
+        self.length = 0
+        self.refs = 1
+        self.lock = Lock()
+
+    @property
+    def data(self):
+        return memoryview(self.buffer)[:self.length]
+
+    def __len__(self):
+        return self.length
+
+    def retain(self):
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            done = self.refs == 0
+        if done:
+            self.pool.release(self.buffer)
+
+class SnapshotError(Exception):
+    pass
+
+def download_frame(session, url, pool, timeout=DEFAULT_FETCH_TIMEOUT):
+    # Streams the snapshot into a pooled buffer in chunks, refusing anything over MAX_FRAME_BYTES
+    # and anything shorter than its Content-Length (a truncated JPEG is worse than a missing one).
+    # requests' timeout is per socket read, so the whole download is held to the same deadline too.
+    deadline = time.monotonic() + timeout
+    with session.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            raise SnapshotError(f"HTTP {response.status_code}")
+        expected = response.headers.get('Content-Length')
+        expected = int(expected) if expected and expected.isdigit() else None
+        if expected is not None and expected > MAX_FRAME_BYTES:
+            raise SnapshotError(f"snapshot is {expected} bytes, over the {MAX_FRAME_BYTES} byte limit")
+
+        frame = pool.acquire()
+        try:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if time.monotonic() > deadline:
+                    raise SnapshotError(f"snapshot took longer than {timeout:.1f}s")
+                if frame.length + len(chunk) > MAX_FRAME_BYTES:
+                    raise SnapshotError(f"snapshot is over the {MAX_FRAME_BYTES} byte limit")
+                # Slice assignment grows the buffer if this frame is the biggest it's held so far
+                frame.buffer[frame.length:frame.length + len(chunk)] = chunk
+                frame.length += len(chunk)
+            if expected is not None and frame.length != expected:
+                raise SnapshotError(f"snapshot truncated, got {frame.length} of {expected} bytes")
+            if frame.length == 0:
+                raise SnapshotError("snapshot was empty")
+        except BaseException:
+            frame.release()
+            raise
+        return frame
+
+def timelapse_filename(camera_ip):
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    return f"TIMELAPSE_{camera_ip}_{timestamp}.mp4"
+
+def record_encode(camera, stage, frames, seconds, returncode):
+    # Streaming encodes run for the whole session, so their fps is bounded by the capture rate rather than ffmpeg
+    labels = {'camera': camera or 'unknown', 'stage': stage}
+    metrics.observe('timelapse_encode_seconds', seconds, **labels)
+    if returncode == 0 and frames:
+        metrics.inc('timelapse_encoded_frames_total', frames, **labels)
+        metrics.set('timelapse_encode_fps', frames / seconds if seconds > 0 else 0.0, **labels)
+    metrics.event('encode', camera=camera, stage=stage, frames=frames, seconds=round(seconds, 3), returncode=returncode)
+    if stage == 'segment' and returncode == 0 and camera:
+        estimator.record_encode(camera, frames, seconds)
+
+class StreamingEncoder:
+    # A long-lived ffmpeg process for one camera, fed each JPEG over stdin (image2pipe) as soon as it's captured.
+    # Stopping then only has to flush the last few frames instead of encoding the whole session.
+    def __init__(self, output_path, framerate, queue_size=STREAM_QUEUE_SIZE, camera=None):
+        self.output_path = output_path
+        self.camera = camera
+        self.frames = Queue(maxsize=queue_size)
+        self.failed = False
+        self.frames_written = 0
+        self.started = time.monotonic()
+        command = [
+            get_ffmpeg_path(),
+            '-y',
+            '-f', 'image2pipe',
+            '-framerate', str(framerate),
+            '-c:v', 'mjpeg',
+            '-i', '-',
+            '-c:v', 'libx264',
+            '-pix_fmt', 'yuv420p',
+            # Fragmented MP4 so whatever was encoded so far is still playable if we get killed mid-session
+            '-movflags', '+frag_keyframe+empty_moov',
+            output_path
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.feeder = Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _feed(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                if not self.failed:
+                    self.process.stdin.write(frame.data)
+                    self.frames_written += 1
+            except (BrokenPipeError, OSError) as exc:
+                print(f"ffmpeg stopped accepting frames for {self.output_path}: {exc}")
+                self.failed = True
+            finally:
+                frame.release()
+
+    def write_frame(self, frame):
+        # Blocks if ffmpeg has fallen a whole queue behind, rather than quietly dropping frames from the video
+        frame.retain()
+        self.frames.put(frame)
+
+    def close(self):
+        self.frames.put(None)
+        self.feeder.join()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        returncode = self.process.wait()
+        record_encode(self.camera, 'stream', self.frames_written, time.monotonic() - self.started, returncode)
+        return returncode
+
+def frame_name(timestamp):
+    return f"image_{int(timestamp)}.jpeg"
+
+def list_frames(folder):
+    # Captured frames in the order they were taken (the filenames are unix timestamps)
+    return sorted(f for f in os.listdir(folder) if f.startswith('image_') and f.endswith('.jpeg'))
+
+class SessionManifest:
+    # Running record of the frames in one camera's session folder, kept in memory and appended to MANIFEST_FILE.
+    # Counters and conversions read from here instead of listing and stat-ing the whole folder.
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE)
+        self.lock = Lock()
+        self.frames = []
+        self.total_bytes = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.file = None
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                for line in file:
+                    parts = line.strip().split(',')
+                    if len(parts) == 3:
+                        self._record(parts[0], int(parts[1]), float(parts[2]))
+        elif os.path.isdir(self.folder):
+            # A folder from before manifests existed, scan it once and write the manifest out
+            image_files = list_frames(self.folder)
+            if image_files:
+                for image_file in image_files:
+                    try:
+                        timestamp = float(image_file[len('image_'):-len('.jpeg')])
+                    except ValueError:
+                        # Not one of ours (image_backup.jpeg and the like), leave it out of the manifest
+                        continue
+                    size = os.path.getsize(os.path.join(self.folder, image_file))
+                    self._record(image_file, size, timestamp)
+                with open(self.path, 'w') as file:
+                    file.writelines(f"{name},{size},{ts}\n" for name, size, ts in self.frames)
+
+    def _record(self, name, size, timestamp):
+        self.frames.append((name, size, timestamp))
+        self.total_bytes += size
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+    def add(self, name, size, timestamp):
+        with self.lock:
+            self._record(name, size, timestamp)
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(f"{name},{size},{timestamp}\n")
+            self.file.flush()
+
+    @property
+    def count(self):
+        return len(self.frames)
+
+    def frame_names(self):
+        with self.lock:
+            return [name for name, _, _ in self.frames]
+
+    def signatures(self, names):
+        # (name, bytes, mtime) per frame, what the render cache keys on. A frame that's gone or been rewritten changes it.
+        result = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+                result.append((name, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                result.append((name, 0, 0))
+        return result
+
+    def read_frames(self, names=None):
+        # Yields (name, timestamp, frame) in capture order, like FrameContainer.read_frames
+        with self.lock:
+            frames = list(self.frames)
+        if names is not None:
+            wanted = set(names)
+            frames = [frame for frame in frames if frame[0] in wanted]
+        for name, _, timestamp in frames:
+            try:
+                with open(os.path.join(self.folder, name), 'rb') as file:
+                    yield name, timestamp, file.read()
+            except FileNotFoundError:
+                continue
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class FrameContainer:
+    # The 'container' storage: every frame of one camera's session is appended to CONTAINER_FILE instead of getting
+    # a file of its own, so a multi-week session is two files rather than hundreds of thousands.
+    # Same interface as SessionManifest, with CONTAINER_INDEX standing in for the manifest.
+    # Data is fsynced before its index records are written, so a crash can lose the last frames but never
+    # leave the index pointing at garbage. Reads go through mmap.
+    def __init__(self, folder):
+        self.folder = folder
+        self.data_path = os.path.join(folder, CONTAINER_FILE)
+        self.index_path = os.path.join(folder, CONTAINER_INDEX)
+        self.lock = Lock()
+        self.frames = []  # (name, offset, length, timestamp)
+        self.total_bytes = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.data_file = None
+        self.index_file = None
+        self.end = 0  # End of the last indexed frame in CONTAINER_FILE
+        self.append_end = 0  # Where the next frame goes
+        self.pending = []  # Written to CONTAINER_FILE but not yet fsynced and indexed
+        self.load()
+
+    def load(self):
+        finish_compaction(self.data_path, self.index_path)
+        if not os.path.exists(self.index_path):
+            return
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        with open(self.index_path, 'rb') as file:
+            index = file.read()
+        # A torn last record (or one pointing past the data) means we crashed mid-write, stop there
+        index = index[:len(index) - len(index) % INDEX_RECORD.size]
+        for offset, length, timestamp in INDEX_RECORD.iter_unpack(index):
+            if offset + length > data_size:
+                break
+            self._record(offset, length, timestamp)
+
+    def _record(self, offset, length, timestamp):
+        self.frames.append((frame_name(timestamp), offset, length, timestamp))
+        self.total_bytes += length
+        self.end = offset + length
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+    def _open_for_append(self):
+        os.makedirs(self.folder, exist_ok=True)
+        # Throw away anything past the last indexed frame, it never made it into the index
+        self.data_file = open(self.data_path, 'ab', buffering=0)
+        self.data_file.truncate(self.end)
+        self.append_end = self.end
+        self.index_file = open(self.index_path, 'ab', buffering=0)
+        self.index_file.truncate(len(self.frames) * INDEX_RECORD.size)
+
+    def append(self, data, timestamp):
+        # Only the disk writer thread appends, the frame counts once commit() has made it durable
+        if self.data_file is None:
+            self._open_for_append()
+        offset = self.append_end
+        written = 0
+        try:
+            while written < len(data):
+                written += self.data_file.write(data[written:] if written else data)
+        finally:
+            # If the write failed part way, the next frame goes after whatever did get written
+            self.append_end += written
+        self.pending.append((offset, len(data), timestamp))
+
+    def _write_index(self, records):
+        written = 0
+        while written < len(records):
+            written += self.index_file.write(records[written:])
+
+    def commit(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            os.fsync(self.data_file.fileno())
+            self._write_index(b''.join(INDEX_RECORD.pack(*record) for record in pending))
+            os.fsync(self.index_file.fileno())
+        except OSError:
+            # Roll the index back to a record boundary so the next batch lines up, these frames are lost
+            self.index_file.truncate(len(self.frames) * INDEX_RECORD.size)
+            raise
+        with self.lock:
+            for record in pending:
+                self._record(*record)
+
+    @property
+    def count(self):
+        return len(self.frames)
+
+    def frame_names(self):
+        with self.lock:
+            return [name for name, _, _, _ in self.frames]
+
+    def signatures(self, names):
+        # Frames are never rewritten in place, so the index says all the render cache needs (offsets move when thinning)
+        with self.lock:
+            records = {name: (length, timestamp) for name, _, length, timestamp in self.frames}
+        return [(name,) + records.get(name, (0, 0)) for name in names]
+
+    def read_frames(self, names=None):
+        # Yields (name, timestamp, frame) for every frame, or just the named ones, in capture order.
+        # frame is a zero-copy view into the mapped file and is only valid until the next one is yielded.
+        with self.lock:
+            frames = list(self.frames)
+        if names is not None:
+            wanted = set(names)
+            frames = [frame for frame in frames if frame[0] in wanted]
+        if not frames:
+            return
+        with open(self.data_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for name, offset, length, timestamp in frames:
+                    with view[offset:offset + length] as frame:
+                        yield name, timestamp, frame
+            finally:
+                view.release()
+
+    def close(self):
+        for file in (self.data_file, self.index_file):
+            if file is not None:
+                file.close()
+        self.data_file = None
+        self.index_file = None
+
+def finish_compaction(data_path, index_path):
+    # A thinned container is written to .thin files, and the index's .thin file only appears once both are complete.
+    # If that's there we were interrupted swapping them in, so finish the job, otherwise throw away the half-written copy.
+    if os.path.exists(index_path + '.thin'):
+        if os.path.exists(data_path + '.thin'):
+            os.replace(data_path + '.thin', data_path)
+        os.replace(index_path + '.thin', index_path)
+    for leftover in (data_path + '.thin', index_path + '.thin.tmp'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+def open_frame_store(folder, storage=None):
+    # The manifest (or container) for a session folder. With no storage given, whichever the folder already uses.
+    if storage is None:
+        storage = 'container' if os.path.exists(os.path.join(folder, CONTAINER_INDEX)) else 'files'
+    if storage == 'container':
+        return FrameContainer(folder)
+    if storage == 'files':
+        return SessionManifest(folder)
+    raise ValueError(f"Unknown frame storage: {storage}")
+
+def export_container(folder, output=None):
+    # Writes a container session back out as loose JPEGs (plus a manifest), by default next to the container
+    container = FrameContainer(folder)
+    output = output or folder
+    os.makedirs(output, exist_ok=True)
+    manifest = SessionManifest(output)
+    existing = set(manifest.frame_names())
+    exported = 0
+    for name, timestamp, frame in container.read_frames():
+        if name in existing:
+            continue
+        with open(os.path.join(output, name), 'wb') as file:
+            file.write(frame)
+        manifest.add(name, len(frame), timestamp)
+        existing.add(name)
+        exported += 1
+    manifest.close()
+    return exported
+
+class ConversionCancelled(Exception):
+    pass
+
+def run_ffmpeg(arguments, on_progress=None, cancel=None, feed=None, low_priority=False):
+    # Runs ffmpeg with the given arguments, passing the frame count from its -progress output to on_progress(frames)
+    # as it goes. feed is an optional iterable of JPEGs to write to its stdin. Raises ConversionCancelled if the
+    # cancel event gets set part way through, after making sure ffmpeg is gone.
+    # low_priority runs it below normal CPU priority, so it only gets what capture and the desktop leave over.
+    command = [get_ffmpeg_path(), '-hide_banner', '-loglevel', 'warning', '-nostats', '-progress', 'pipe:1']
+    if feed is None:
+        command.append('-nostdin')
+    options = {}
+    if low_priority and os.name == 'nt':
+        options['creationflags'] = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    elif low_priority and shutil.which('nice'):
+        command = ['nice', '-n', '10'] + command
+    process = subprocess.Popen(command + arguments, stdout=subprocess.PIPE,
+                               stdin=subprocess.PIPE if feed is not None else subprocess.DEVNULL, **options)
+
+    def read_progress():
+        for line in process.stdout:
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            if key == 'frame' and value.isdigit() and on_progress:
+                on_progress(int(value))
+
+    reader = Thread(target=read_progress, daemon=True)
+    reader.start()
+    try:
+        if feed is not None:
+            try:
+                for frame in feed:
+                    if cancel is not None and cancel.is_set():
+                        break
+                    process.stdin.write(frame)
+            except (BrokenPipeError, OSError) as exc:
+                print(f"ffmpeg stopped accepting frames: {exc}")
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        terminated = False
+        while True:
+            try:
+                returncode = process.wait(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel is not None and cancel.is_set() and not terminated:
+                    process.terminate()
+                    terminated = True
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        reader.join()
+    if cancel is not None and cancel.is_set():
+        raise ConversionCancelled()
+    return returncode
+
+def render_key(signatures, **settings):
+    # Content address of a render: the ordered frames it's made from plus everything that changes how it's encoded
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for signature in signatures:
+        digest.update(('/'.join(map(str, signature)) + '\n').encode())
+    return digest.hexdigest()
+
+def link_or_copy(source, destination):
+    # Hard links make a cache hit instant and cost no extra disk, across filesystems we have to copy
+    temp_path = destination + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+class RenderCache:
+    # Finished renders stored as RENDER_CACHE_DIR/<key>.mp4, where the key is render_key() of what went into them.
+    # index.json remembers each one's size and when it was last used, the least recently used go once over budget.
+    # Anything that writes into a cached file's path must remove it first, as it may be a hard link into the cache.
+    def __init__(self, folder=RENDER_CACHE_DIR, budget=RENDER_CACHE_BUDGET):
+        self.folder = folder
+        self.budget = budget
+        self.lock = Lock()
+        self.index_path = os.path.join(folder, 'index.json')
+        self.entries = None  # key -> {'size', 'used', 'label'}, read on first use
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.mp4')
+
+    def load(self):
+        if self.entries is not None:
+            return
+        entries = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as file:
+                    entries = json.load(file)
+            except (OSError, ValueError):
+                print(f"Couldn't read {self.index_path}, starting with an empty render cache.")
+        self.entries = {key: entry for key, entry in entries.items() if os.path.exists(self.path(key))}
+
+    def save(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.entries, file, indent=1)
+        os.replace(temp_path, self.index_path)
+
+    @property
+    def enabled(self):
+        return self.budget != 0
+
+    def fetch(self, key, destination):
+        # Puts the cached render for key at destination, returns False if there isn't one
+        if not self.enabled:
+            return False
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is not None:
+                try:
+                    link_or_copy(self.path(key), destination)
+                    entry['used'] = time.time()
+                except OSError as exc:
+                    print(f"Couldn't reuse cached render {key[:12]}: {exc}")
+                    del self.entries[key]
+                    entry = None
+                self.save()
+        metrics.inc('timelapse_render_cache_total', result='miss' if entry is None else 'hit')
+        return entry is not None
+
+    def store(self, key, source, label=None):
+        if not self.enabled or not os.path.exists(source):
+            return
+        size = os.path.getsize(source)
+        if self.budget is not None and size > self.budget:
+            return
+        with self.lock:
+            self.load()
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                link_or_copy(source, self.path(key))
+                self.entries[key] = {'size': size, 'used': time.time(), 'label': label}
+                self.evict()
+                self.save()
+            except OSError as exc:
+                print(f"Couldn't add {source} to the render cache: {exc}")
+
+    def evict(self):
+        if self.budget is None:
+            return
+        total = sum(entry['size'] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['used']):
+            if total <= self.budget:
+                break
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            total -= entry['size']
+            del self.entries[key]
+
+    def usage(self):
+        with self.lock:
+            self.load()
+            return len(self.entries), sum(entry['size'] for entry in self.entries.values())
+
+    def clear(self):
+        with self.lock:
+            self.load()
+            for key in self.entries:
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+            self.entries = {}
+            if os.path.isdir(self.folder):
+                self.save()
+
+# Shared by every encode in this process
+render_cache = RenderCache()
+
+def frame_brightness(frame):
+    # A 1/8 scale draft decode is plenty to measure brightness, and skips nearly all the decoding work
+    try:
+        with Image.open(BytesIO(frame)) as image:
+            image.draft('L', (64, 64))
+            return np.asarray(image.convert('L').resize((64, 64)), dtype=np.uint8)
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+def apply_gain(frame, gain):
+    # Runs in a worker process. A lookup table per channel keeps the per-pixel work inside Pillow.
+    with Image.open(BytesIO(frame)) as image:
+        image = image.convert('RGB')
+    table = [min(255, round(value * gain)) for value in range(256)] * 3
+    output = BytesIO()
+    image.point(table).save(output, 'JPEG', quality=DEFLICKER_QUALITY)
+    return output.getvalue()
+
+def deflicker_available():
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+    if np is None or Image is None:
+        print("Deflicker needs NumPy and Pillow (pip install numpy pillow), encoding without it.")
+        return False
+    return True
+
+class Deflicker:
+    # Evens out the brightness jumps auto-exposure makes at dawn and dusk. Every frame's mean brightness is measured
+    # (and cached in DEFLICKER_STATS), smoothed with a moving average over DEFLICKER_WINDOW frames, and each frame is
+    # scaled by smoothed / measured on its way into ffmpeg. Slow changes like sunset survive, frame to frame jumps don't.
+    def __init__(self, folder, window=DEFLICKER_WINDOW, max_gain=DEFLICKER_MAX_GAIN):
+        self.folder = folder
+        self.window = window
+        self.max_gain = max_gain
+        self.stats_path = os.path.join(folder, DEFLICKER_STATS)
+        self.stats = self.load_stats()  # name -> [bytes, mtime or timestamp, brightness]
+        self.gains = {}
+        self.pool = None  # Worker processes for corrected_frames, kept for a whole encode by start_pool()
+
+    @property
+    def settings(self):
+        # Anything that changes the output, for segments.json and render cache keys
+        return {'window': self.window, 'max_gain': self.max_gain, 'quality': DEFLICKER_QUALITY}
+
+    def load_stats(self):
+        if not os.path.exists(self.stats_path):
+            return {}
+        try:
+            with open(self.stats_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            print(f"Couldn't read {self.stats_path}, measuring every frame again.")
+            return {}
+
+    def save_stats(self):
+        temp_path = self.stats_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.stats, file)
+        os.replace(temp_path, self.stats_path)
+
+    def analyse(self, manifest, names):
+        # Measures the frames that aren't in the cache (or have changed since), a batch at a time
+        signatures = {name: signature for name, *signature in manifest.signatures(names)}
+        missing = [name for name in names if self.stats.get(name, [None, None])[:2] != signatures[name]]
+        if not missing:
+            return
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            def measure(batch):
+                thumbnails = list(pool.map(frame_brightness, [frame for _, frame in batch]))
+                measured = [(name, thumbnail) for (name, _), thumbnail in zip(batch, thumbnails) if thumbnail is not None]
+                if measured:
+                    # Every frame in the batch in one go
+                    means = np.stack([thumbnail for _, thumbnail in measured]).reshape(len(measured), -1).mean(axis=1)
+                    for (name, _), mean in zip(measured, means.tolist()):
+                        self.stats[name] = signatures[name] + [round(mean, 3)]
+
+            batch = []
+            for name, _, frame in manifest.read_frames(missing):
+                batch.append((name, bytes(frame)))
+                if len(batch) == FRAME_POOL_SIZE:
+                    measure(batch)
+                    batch = []
+            measure(batch)
+        self.save_stats()
+        print(f"Measured the brightness of {len(missing)} frames in {self.folder} in {time.monotonic() - started:.1f}s")
+
+    def compute_gains(self, manifest, names):
+        # Gains for every frame, smoothing over the whole session so chunk boundaries don't show
+        self.analyse(manifest, names)
+        if not names:
+            return
+        brightness = np.array([self.stats[name][2] if name in self.stats else np.nan for name in names])
+        # Frames we couldn't measure take their neighbours' brightness, so they come out uncorrected
+        known = ~np.isnan(brightness)
+        if not known.any():
+            self.gains = {}
+            return
+        brightness = np.interp(np.arange(len(names)), np.flatnonzero(known), brightness[known])
+        # Averaged in log space, so doubling and halving the exposure pull equally hard
+        log_brightness = np.log(np.maximum(brightness, 1.0))
+        window = max(1, min(self.window, len(names)))
+        padded = np.pad(log_brightness, (window // 2, window - 1 - window // 2), mode='edge')
+        smoothed = np.convolve(padded, np.ones(window) / window, mode='valid')
+        gains = np.clip(np.exp(smoothed - log_brightness), 1 / self.max_gain, self.max_gain)
+        self.gains = dict(zip(names, gains.tolist()))
+
+    def start_pool(self, workers=None):
+        # Spawned rather than forked: a fork copies whatever locks the capture and writer threads happen to be
+        # holding, and the workers can hang on them. Spawning costs a fresh interpreter per worker, so the pool
+        # is started once per encode and shared by all its chunks.
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def corrected_frames(self, manifest, names, workers=None):
+        # Yields each frame with its gain applied, in order, spread over a pool of processes.
+        # Frames that barely need correcting are passed through untouched rather than recompressed.
+        own_pool = self.pool is None
+        self.start_pool(workers)
+        pool = self.pool
+        try:
+            def correct(batch):
+                jobs = [(frame, gain) for frame, gain in batch if abs(gain - 1) >= 0.01]
+                corrected = iter(pool.map(apply_gain, *zip(*jobs))) if jobs else iter(())
+                return [next(corrected) if abs(gain - 1) >= 0.01 else frame for frame, gain in batch]
+
+            batch = []
+            for name, _, frame in manifest.read_frames(names):
+                batch.append((bytes(frame), self.gains.get(name, 1.0)))
+                if len(batch) == FRAME_POOL_SIZE:
+                    yield from correct(batch)
+                    batch = []
+            yield from correct(batch)
+        finally:
+            if own_pool:
+                self.stop_pool()
+
+class SegmentedEncoder:
+    # Encodes a session folder in fixed-size chunks and stitches them together with a stream-copy concat.
+    # Finished chunks are recorded in SEGMENT_INDEX, so a later run only has to encode the frames after them.
+    def __init__(self, folder, framerate, segment_frames=SEGMENT_FRAMES, camera=None, deflicker=False):
+        self.folder = folder
+        self.camera = camera
+        self.framerate = str(framerate)
+        self.segment_frames = segment_frames
+        self.deflicker = Deflicker(folder) if deflicker and deflicker_available() else None
+        self.lock = Lock()  # Capture-time encodes and the final encode must never overlap
+        self.index_path = os.path.join(folder, SEGMENT_INDEX)
+        self.segments = self.load_index()
+        self.manifest = None  # Set by the capture path so background encodes can read the live manifest
+        self.threads = None  # ffmpeg -threads, set when several conversions share the CPU
+        self.low_priority = False  # Run ffmpeg below normal priority, for encodes nobody is waiting on
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return []
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            print(f"Couldn't read {self.index_path}, re-encoding the whole folder.")
+            return []
+
+        segments = [seg for seg in index.get('segments', []) if os.path.exists(os.path.join(self.folder, seg['file']))]
+        if (index.get('framerate') != self.framerate or index.get('deflicker') != self.deflicker_settings
+                or len(segments) != len(index.get('segments', []))):
+            # Chunks at a different frame rate or deflicker setting (or with missing files) can't be concatenated,
+            # start over
+            for seg in segments:
+                os.remove(os.path.join(self.folder, seg['file']))
+            return []
+        return segments
+
+    def save_index(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'framerate': self.framerate, 'deflicker': self.deflicker_settings, 'segments': self.segments},
+                      file, indent=1)
+        os.replace(temp_path, self.index_path)
+
+    @property
+    def deflicker_settings(self):
+        return self.deflicker.settings if self.deflicker else None
+
+    def pending_frames(self, image_files):
+        if not self.segments:
+            return list(image_files)
+        last_encoded = self.segments[-1]['last']
+        return [f for f in image_files if f > last_encoded]
+
+    def output_options(self, segment_name):
+        options = list(VIDEO_OPTIONS)
+        if self.threads:
+            options += ['-threads', str(self.threads)]
+        return options + [os.path.join(self.folder, segment_name)]
+
+    def render_key(self, frames, stage):
+        if self.manifest is None:
+            return None
+        settings = dict(stage=stage, framerate=self.framerate, options=VIDEO_OPTIONS, segment_frames=self.segment_frames)
+        if self.deflicker:
+            settings['deflicker'] = self.deflicker_settings
+        if self.deflicker and stage == 'segment':
+            # A frame's gain depends on frames either side of the chunk too, so the gains themselves are part of the key
+            settings['gains'] = [round(self.deflicker.gains.get(name, 1.0), 3) for name in frames]
+        return render_key(self.manifest.signatures(frames), **settings)
+
+    def encode_segment(self, frames, on_progress=None, cancel=None):
+        segment_name = f"segment_{len(self.segments):04}.mp4"
+        segment_path = os.path.join(self.folder, segment_name)
+        if os.path.exists(segment_path):
+            os.remove(segment_path)  # Might be a hard link into the render cache, don't let ffmpeg write through it
+
+        # The same chunk may have been encoded before, e.g. before switching frame rate and back
+        key = self.render_key(frames, 'segment')
+        if key and render_cache.fetch(key, segment_path):
+            if on_progress:
+                on_progress(len(frames))
+        else:
+            encode_start = time.monotonic()
+            if self.deflicker:
+                feed = self.deflicker.corrected_frames(self.manifest, frames, self.threads)
+                returncode = self.encode_from_pipe(feed, segment_name, on_progress, cancel)
+            elif isinstance(self.manifest, FrameContainer):
+                # Pipe the JPEGs straight out of the mapped container, nothing is unpacked to disk
+                feed = (frame for _, _, frame in self.manifest.read_frames(frames))
+                returncode = self.encode_from_pipe(feed, segment_name, on_progress, cancel)
+            else:
+                returncode = self.encode_from_files(frames, segment_name, on_progress, cancel)
+            record_encode(self.camera, 'segment', len(frames), time.monotonic() - encode_start, returncode)
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg failed encoding {segment_name} in {self.folder}")
+            if key:
+                render_cache.store(key, segment_path, f"{self.camera} {os.path.basename(self.folder)} {segment_name}")
+
+        self.segments.append({'file': segment_name, 'first': frames[0], 'last': frames[-1], 'frames': len(frames)})
+        self.save_index()
+
+    def encode_from_files(self, frames, segment_name, on_progress=None, cancel=None):
+        filelist_path = os.path.join(self.folder, segment_name[:-len('.mp4')] + '.txt')
+        with open(filelist_path, 'w') as file:
+            for image_file in frames:
+                file.write(f"file '{image_file}'\n")
+
+        # -r before -i stamps the concatenated JPEGs at our frame rate
+        arguments = [
+            '-y',
+            '-r', self.framerate,
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', filelist_path,
+        ] + self.output_options(segment_name)
+        try:
+            return run_ffmpeg(arguments, on_progress, cancel, low_priority=self.low_priority)
+        finally:
+            os.remove(filelist_path)
+
+    def encode_from_pipe(self, feed, segment_name, on_progress=None, cancel=None):
+        # feed yields the chunk's JPEGs, which go to ffmpeg over stdin
+        arguments = [
+            '-y',
+            '-f', 'image2pipe',
+            '-framerate', self.framerate,
+            '-c:v', 'mjpeg',
+            '-i', '-',
+        ] + self.output_options(segment_name)
+        return run_ffmpeg(arguments, on_progress, cancel, feed, self.low_priority)
+
+    def encode_full_segments(self, image_files):
+        # Called while capture is still running, only ever encodes complete chunks
+        with self.lock:
+            pending = self.pending_frames(image_files)
+            lookahead = 0
+            if self.deflicker:
+                # Deflicker smooths over frames either side, so wait for the ones just after the chunk too
+                lookahead = self.deflicker.window // 2
+                if len(pending) >= self.segment_frames + lookahead:
+                    self.deflicker.compute_gains(self.manifest, image_files)
+                    self.deflicker.start_pool(self.threads)
+            try:
+                while len(pending) >= self.segment_frames + lookahead:
+                    self.encode_segment(pending[:self.segment_frames])
+                    pending = pending[self.segment_frames:]
+            finally:
+                if self.deflicker:
+                    self.deflicker.stop_pool()
+
+    def finish(self, image_files, output_path, on_progress=None, cancel=None):
+        # Encode whatever's left (including the last partial chunk) and concat every chunk into the final video.
+        # on_progress(frames done, frames to do) is called as ffmpeg works through the remaining frames.
+        with self.lock:
+            pending = self.pending_frames(image_files)
+            if self.deflicker and pending:
+                self.deflicker.compute_gains(self.manifest, image_files)
+                self.deflicker.start_pool(self.threads)
+            total = len(pending)
+            done = 0
+            try:
+                while pending:
+                    chunk = pending[:self.segment_frames]
+                    report = (lambda frames, base=done: on_progress(base + frames, total)) if on_progress else None
+                    self.encode_segment(chunk, report, cancel)
+                    done += len(chunk)
+                    pending = pending[len(chunk):]
+            finally:
+                if self.deflicker:
+                    self.deflicker.stop_pool()
+
+            if not self.segments:
+                print(f"No frames to convert in {self.folder}")
+                return False
+
+            concat_path = os.path.join(self.folder, "segments.txt")
+            with open(concat_path, 'w') as file:
+                for seg in self.segments:
+                    file.write(f"file '{seg['file']}'\n")
+            arguments = [
+                '-y',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', concat_path,
+                '-c', 'copy',
+                output_path
+            ]
+            concat_start = time.monotonic()
+            try:
+                returncode = run_ffmpeg(arguments, cancel=cancel)
+            finally:
+                os.remove(concat_path)
+            # A stream copy, so no frames are counted as encoded here
+            record_encode(self.camera, 'concat', 0, time.monotonic() - concat_start, returncode)
+            return returncode == 0
+
+class FrameDeduplicator:
+    # Drops frames that barely differ from the last frame we kept (empty rooms, nights), per camera.
+    # With Pillow we compare a tiny greyscale thumbnail, decoded cheaply via JPEG draft mode.
+    def __init__(self, threshold=DEDUP_THRESHOLD, keep_every=DEDUP_KEEP_EVERY):
+        self.threshold = threshold
+        self.keep_every = keep_every
+        self.last_kept = None
+        self.since_kept = 0
+        self.frames_skipped = 0
+        self.bytes_saved = 0
+
+    def signature(self, data):
+        if Image is None:
+            return hashlib.sha1(data).digest()
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image.draft('L', (64, 64))
+                return image.convert('L').resize((16, 16)).tobytes()
+        except OSError:
+            # Not a JPEG Pillow can read, fall back to an exact comparison
+            return hashlib.sha1(data).digest()
+
+    def difference(self, a, b):
+        if len(a) != 16 * 16 or len(b) != 16 * 16:
+            # At least one side is a hash, so all we can say is same or different
+            return 0.0 if a == b else 1.0
+        return sum(abs(x - y) for x, y in zip(a, b)) / (255 * len(a))
+
+    def should_keep(self, data):
+        signature = self.signature(data)
+        self.since_kept += 1
+        if (self.last_kept is None or self.since_kept >= self.keep_every
+                or self.difference(signature, self.last_kept) >= self.threshold):
+            self.last_kept = signature
+            self.since_kept = 0
+            return True
+
+        self.frames_skipped += 1
+        self.bytes_saved += len(data)
+        return False
+
+class FrameWriter:
+    # The disk stage of the capture pipeline. Fetchers hand frames over through a bounded queue and get straight
+    # back to the network, so a slow NAS holds up the queue instead of the next camera's fetch.
+    # Frames go to temp files, get fsynced in batches, then renamed into place, so a crash never leaves half a JPEG.
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE, fsync_batch=FSYNC_BATCH, fsync_interval=FSYNC_INTERVAL):
+        self.jobs = Queue(maxsize=queue_size)
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.created_dirs = set()
+        self.containers = {}  # folder -> FrameContainer, for sessions using 'container' storage
+        self.pending = []  # (temp path or FrameContainer, final path, on_written) waiting for the next fsync batch
+        self.last_sync = time.monotonic()
+        self.write_latency = deque(maxlen=1000)
+        self.max_depth = 0
+        self.errors = 0
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, folder, filename, frame, on_written=None, camera=None, timestamp=None):
+        # Blocks when the queue is full, which is the backpressure on the fetchers.
+        # Takes over the caller's reference to the frame and releases it once written.
+        self.jobs.put((folder, filename, frame, on_written, camera, timestamp))
+        depth = self.jobs.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        metrics.set('timelapse_write_queue_depth', depth)
+
+    def _run(self):
+        while True:
+            timeout = max(0.0, self.last_sync + self.fsync_interval - time.monotonic()) if self.pending else None
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except Empty:
+                self._sync()
+                continue
+            if job is None:
+                break
+            self._write(*job)
+            if len(self.pending) >= self.fsync_batch or time.monotonic() - self.last_sync >= self.fsync_interval:
+                self._sync()
+        self._sync()
+
+    def _write(self, folder, filename, frame, on_written, camera, timestamp):
+        write_start = time.monotonic()
+        try:
+            container = self.containers.get(folder)
+            if container is not None:
+                container.append(frame.data, timestamp if timestamp is not None else time.time())
+                self.pending.append((container, None, on_written))
+            else:
+                if folder not in self.created_dirs:
+                    os.makedirs(folder, exist_ok=True)
+                    self.created_dirs.add(folder)
+                final_path = os.path.join(folder, filename)
+                temp_path = final_path + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(frame.data)
+                self.pending.append((temp_path, final_path, on_written))
+        except OSError as exc:
+            self.errors += 1
+            print(f"Couldn't write {filename} to {folder}: {exc}")
+        finally:
+            frame.release()
+        write_time = time.monotonic() - write_start
+        self.write_latency.append(write_time)
+        metrics.observe('timelapse_write_seconds', write_time, camera=camera or 'unknown')
+
+    def _sync(self):
+        # Containers fsync and index their whole batch in one go
+        failed_containers = set()
+        for container in {target for target, final_path, _ in self.pending if final_path is None}:
+            try:
+                container.commit()
+            except OSError as exc:
+                self.errors += 1
+                failed_containers.add(container)
+                print(f"Couldn't finish writing to {container.data_path}: {exc}")
+
+        synced_dirs = set()
+        for temp_path, final_path, on_written in self.pending:
+            if final_path is None:
+                if temp_path in failed_containers:
+                    continue
+            else:
+                try:
+                    with open(temp_path, 'rb+') as f:
+                        os.fsync(f.fileno())
+                    os.replace(temp_path, final_path)
+                except OSError as exc:
+                    self.errors += 1
+                    print(f"Couldn't finish writing {final_path}: {exc}")
+                    continue
+                synced_dirs.add(os.path.dirname(final_path))
+            if on_written:
+                on_written()
+
+        # Make the renames themselves durable (directories can't be opened like this on Windows)
+        if os.name == 'posix':
+            for folder in synced_dirs:
+                try:
+                    fd = os.open(folder, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+
+        self.pending = []
+        self.last_sync = time.monotonic()
+
+    def summary(self):
+        samples = list(self.write_latency)
+        return (f"Disk writer: queue depth {self.jobs.qsize()} (max {self.max_depth}), "
+                f"write p50 {percentile(samples, 50) * 1000:.0f}ms, p99 {percentile(samples, 99) * 1000:.0f}ms, "
+                f"{self.errors} errors")
+
+    def close(self):
+        # Drains everything still queued before returning
+        self.jobs.put(None)
+        self.thread.join()
+
+class CameraHealth:
+    # Tracks how one camera is behaving so a slow or dead camera can't hold up the others.
+    # 'ok' and 'degraded' cameras are fetched every tick, 'down' ones are left out (circuit open)
+    # and only re-probed in the background once their backoff has run out.
+    def __init__(self, camera):
+        self.camera = camera
+        self.state = 'ok'
+        self.latency = None  # Exponentially weighted average of successful fetch times
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.lock = Lock()
+
+    def timeout(self):
+        if self.latency is None:
+            return DEFAULT_FETCH_TIMEOUT
+        return max(MIN_FETCH_TIMEOUT, min(MAX_FETCH_TIMEOUT, self.latency * TIMEOUT_LATENCY_FACTOR))
+
+    def available(self):
+        return self.state != 'down'
+
+    def due_for_probe(self):
+        return self.state == 'down' and time.monotonic() >= self.retry_at
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.state == 'down':
+                print(f"{self.camera} is back online")
+            self.state = 'ok'
+            self.consecutive_failures = 0
+            self.last_error = None
+
+    def record_failure(self, error):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            if self.consecutive_failures < CIRCUIT_FAILURE_THRESHOLD:
+                self.state = 'degraded'
+                return
+            if self.state != 'down':
+                print(f"{self.camera} failed {self.consecutive_failures} times in a row, taking it out of capture")
+            self.state = 'down'
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.consecutive_failures - CIRCUIT_FAILURE_THRESHOLD))
+            self.retry_at = time.monotonic() + backoff
+
+    def describe(self):
+        if self.state == 'down':
+            return f"offline, retrying in {max(0, int(self.retry_at - time.monotonic()))}s"
+        if self.state == 'degraded':
+            return f"{self.consecutive_failures} failed"
+        return f"ok, {self.latency * 1000:.0f}ms" if self.latency is not None else "ok"
+
+class CaptureEngine:
+    # Fetches every selected camera at the same time on each tick, instead of one after another.
+    # Each camera gets its own requests.Session so the HTTP connection is kept alive between ticks.
+    def __init__(self, cameras, session_name, max_workers=MAX_CAPTURE_WORKERS, encoders=None, manifests=None, dedupers=None,
+                 health=None):
+        self.cameras = list(cameras)
+        self.session_name = session_name
+        self.health = health or {camera: CameraHealth(camera) for camera in self.cameras}
+        self.encoders = encoders or {}  # camera -> StreamingEncoder, when encoding while capturing
+        self.manifests = manifests or {}  # camera -> SessionManifest or FrameContainer, updated as each frame lands on disk
+        self.dedupers = dedupers or {}  # camera -> FrameDeduplicator, when skipping near-identical frames
+        self.last_second = {}  # camera -> whole second of its newest frame, so a slow fetch can't clobber a newer name
+        self.last_second_lock = Lock()
+        self.in_flight = set()  # Cameras with a fetch still going
+        self.in_flight_lock = Lock()
+        self.writer = FrameWriter()
+        self.writer.containers = {manifest.folder: manifest for manifest in self.manifests.values()
+                                  if isinstance(manifest, FrameContainer)}
+        self.pool = BufferPool()
+        self.sessions = {camera: requests.Session() for camera in self.cameras}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self.cameras))))
+
+        # Offline cameras get re-probed on their own thread so they never slow down a tick
+        self.closing = Event()
+        self.prober = Thread(target=self.probe_offline_cameras, daemon=True)
+        self.prober.start()
+
+    def fetch_snapshot(self, camera):
+        health = self.health[camera]
+        fetch_start = time.monotonic()
+        frame = download_frame(self.sessions[camera], f"http://{camera}{CHECK_EXTENSION}", self.pool, health.timeout())
+        fetched_at = time.time()
+        fetch_time = time.monotonic() - fetch_start
+        health.record_success(fetch_time)
+        metrics.observe('timelapse_fetch_seconds', fetch_time, camera=camera)
+        metrics.inc('timelapse_fetch_bytes_total', len(frame), camera=camera)
+        estimator.record_fetch(camera, len(frame), fetch_time)
+        if camera in self.dedupers and not self.dedupers[camera].should_keep(frame.data):
+            # Fetched fine, just not worth storing or encoding
+            frame.release()
+            return fetched_at
+
+        with self.last_second_lock:
+            second = int(fetched_at)
+            if second <= self.last_second.get(camera, -1):
+                # Another fetch of this camera already landed in this second (or a later one), keep that frame
+                frame.release()
+                return fetched_at
+            self.last_second[camera] = second
+
+        folder_path = os.path.join(SNAPSHOT_DIR, camera, self.session_name)
+        filename = frame_name(fetched_at)
+        on_written = None
+        if isinstance(self.manifests.get(camera), SessionManifest):
+            # Only counted once it's safely on disk (containers count their own frames as they're committed)
+            manifest = self.manifests[camera]
+            size = len(frame)
+            on_written = lambda: manifest.add(filename, size, fetched_at)
+        if camera in self.encoders:
+            self.encoders[camera].write_frame(frame)
+        self.writer.submit(folder_path, filename, frame, on_written, camera, fetched_at)
+        metrics.inc('timelapse_frames_total', camera=camera)
+        return fetched_at
+
+    def probe_offline_cameras(self):
+        session = requests.Session()
+        while not self.closing.wait(1.0):
+            for camera, health in self.health.items():
+                if self.closing.is_set() or not health.due_for_probe():
+                    continue
+                probe_start = time.monotonic()
+                try:
+                    frame = download_frame(session, f"http://{camera}{CHECK_EXTENSION}", self.pool, health.timeout())
+                    frame.release()
+                    health.record_success(time.monotonic() - probe_start)
+                except Exception as exc:
+                    health.record_failure(exc)
+        session.close()
+
+    def capture_tick(self, cameras=None, log=True):
+        # Fire off every camera (or just the ones that are due) at once, then wait for all of them to come back
+        done = Event()
+        reports = []
+        self.submit_tick(cameras, lambda report: (reports.append(report), done.set()), log)
+        done.wait()
+        return reports[0]
+
+    def submit_tick(self, cameras, on_done, log=False):
+        # Same as capture_tick without waiting: the fetches go to the executor and on_done(report) is called from
+        # whichever fetch finishes last. A camera whose previous fetch is still going is left out this time.
+        tick_start = time.time()
+        cameras = self.cameras if cameras is None else cameras
+        live_cameras = [camera for camera in cameras if self.health[camera].available()]
+        with self.in_flight_lock:
+            busy = [camera for camera in live_cameras if camera in self.in_flight]
+            live_cameras = [camera for camera in live_cameras if camera not in self.in_flight]
+            self.in_flight.update(live_cameras)
+        captured = {}
+        failed = []
+        remaining = [len(live_cameras)]
+        lock = Lock()
+
+        def finish():
+            # Skew is the spread between the first and last camera to come back in this tick
+            skew = max(captured.values()) - min(captured.values()) if captured else 0.0
+            report = {
+                'captured': len(captured),
+                'captured_cameras': set(captured),
+                'failed': failed,
+                'offline': [camera for camera in cameras if camera not in live_cameras and camera not in busy],
+                'busy': busy,
+                'skew': skew,
+                'duration': time.time() - tick_start,
+                'write_queue': self.writer.jobs.qsize(),
+            }
+            if log:
+                print(f"Tick: {report['captured']}/{len(cameras)} cameras in {report['duration']:.2f}s, "
+                      f"skew {skew * 1000:.0f}ms, {len(report['offline'])} offline, write queue {report['write_queue']}")
+            on_done(report)
+
+        def fetched(future, camera):
+            try:
+                result = future.result()
+            except Exception as exc:
+                # Whatever went wrong, it only costs this camera this tick
+                print(f'{camera} snapshot failed: {exc}')
+                self.health[camera].record_failure(exc)
+                metrics.inc('timelapse_fetch_failures_total', camera=camera, type=type(exc).__name__)
+                metrics.event('fetch_failed', camera=camera, type=type(exc).__name__, error=str(exc),
+                              state=self.health[camera].state)
+                result = None
+            with self.in_flight_lock:
+                self.in_flight.discard(camera)
+            with lock:
+                if result is None:
+                    failed.append(camera)
+                else:
+                    captured[camera] = result
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                finish()
+
+        if not live_cameras:
+            finish()
+        for camera in live_cameras:
+            future = self.executor.submit(self.fetch_snapshot, camera)
+            future.add_done_callback(lambda future, camera=camera: fetched(future, camera))
+
+    def close(self):
+        self.closing.set()
+        self.prober.join()
+        self.executor.shutdown(wait=True)
+        self.writer.close()
+        print(self.writer.summary())
+        for session in self.sessions.values():
+            session.close()
+
+
+class ScheduleWindow:
+    # One recurring capture window, e.g. 08:00-17:00 on weekdays. An end at or before the start runs past
+    # midnight (22:00-06:00 records overnight), and counts as part of the day it starts on.
+    def __init__(self, start, end, weekdays=None):
+        self.start = datetime.strptime(start, "%H:%M").time()
+        self.end = datetime.strptime(end, "%H:%M").time()
+        self.weekdays = set(range(7) if weekdays is None else weekdays)  # Monday is 0
+
+    def occurrences(self, first_day, days):
+        # (start, end) datetimes of each time this window opens over the given days
+        for n in range(days):
+            day = first_day + timedelta(days=n)
+            if day.weekday() not in self.weekdays:
+                continue
+            start = datetime.combine(day, self.start)
+            end = datetime.combine(day, self.end)
+            if end <= start:
+                end += timedelta(days=1)
+            yield start, end
+
+    def __str__(self):
+        days = '' if len(self.weekdays) == 7 else ','.join(WEEKDAYS[day] for day in sorted(self.weekdays)) + '@'
+        return f"{days}{self.start:%H:%M}-{self.end:%H:%M}"
+
+def next_schedule_transition(windows, now):
+    # Returns (recording, when): whether now falls inside any window, and when that next changes (None if never).
+    # Overlapping and back-to-back windows are merged, so capture isn't stopped and restarted between them.
+    spans = sorted(span for window in windows for span in window.occurrences(now.date() - timedelta(days=1), 9))
+    merged = []
+    for start, end in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    for start, end in merged:
+        if end <= now:
+            continue
+        if start <= now:
+            return True, end
+        return False, start
+    return False, None
+
+def session_started(folder):
+    # Session folders are named after the time they started
+    try:
+        return time.mktime(time.strptime(os.path.basename(folder), "%Y-%m-%d_%H-%M-%S"))
+    except ValueError:
+        return os.path.getmtime(folder)
+
+def list_sessions():
+    # (start time, camera, folder) for every session under SNAPSHOT_DIR, oldest first
+    sessions = []
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return sessions
+    for camera in os.listdir(SNAPSHOT_DIR):
+        camera_dir = os.path.join(SNAPSHOT_DIR, camera)
+        if not os.path.isdir(camera_dir):
+            continue
+        for name in os.listdir(camera_dir):
+            folder = os.path.join(camera_dir, name)
+            if os.path.isdir(folder):
+                sessions.append((session_started(folder), camera, folder))
+    return sorted(sessions)
+
+def folder_size(folder):
+    # The session's files plus its thumbnails
+    total = 0
+    for path in (folder, os.path.join(folder, THUMBNAIL_DIR)):
+        try:
+            total += sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        except FileNotFoundError:
+            pass
+    return total
+
+def is_video(filename):
+    return filename.startswith('TIMELAPSE_') and filename.endswith('.mp4')
+
+def mark_encoded(folder, video, frames):
+    # Only written once ffmpeg has finished, so a half-written video left by a crash never counts as encoded
+    path = os.path.join(folder, ENCODED_MARKER)
+    with open(path + '.tmp', 'w') as file:
+        json.dump({'video': os.path.basename(video), 'frames': frames, 'encoded': time.time()}, file)
+    os.replace(path + '.tmp', path)
+
+def is_encoded(folder):
+    # The session has a finished video with every frame it still has in it
+    try:
+        with open(os.path.join(folder, ENCODED_MARKER), 'r') as file:
+            marker = json.load(file)
+    except (OSError, ValueError):
+        return False
+    if not os.path.exists(os.path.join(folder, marker.get('video', ''))):
+        return False
+    return marker.get('frames', 0) >= open_frame_store(folder).count
+
+class RetentionManager:
+    # Keeps SNAPSHOT_DIR within its budgets from a background thread. Old sessions are thinned per THINNING_RULES,
+    # encoded ones lose their frames after DELETE_ENCODED_AFTER_DAYS, and if a budget is still exceeded the oldest
+    # sessions are worked through: frames of encoded sessions go first, then frames are thinned harder, and only then
+    # is a whole session deleted. Sessions that are being captured are never touched.
+    # Everything defaults to off, in which case all this does is forecast when the disk will fill up.
+    def __init__(self, active_folders=None, capture_rate=None):
+        self.active_folders = active_folders or set  # Returns the folders currently being captured into
+        self.capture_rate = capture_rate or (lambda: 0.0)  # Returns the bytes/s currently being captured
+        self.camera_budget = RETENTION_CAMERA_BUDGET
+        self.total_budget = RETENTION_TOTAL_BUDGET
+        self.rules = THINNING_RULES
+        self.delete_encoded_after = DELETE_ENCODED_AFTER_DAYS
+        self.interval = RETENTION_INTERVAL
+        self.freed_bytes = 0
+        self.stopping = Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                self.run_pass()
+            except Exception:
+                print("Retention pass failed:")
+                traceback.print_exc()
+            if self.stopping.wait(self.interval):
+                break
+
+    def pause(self):
+        # Called after every deletion, returns True if we've been asked to stop
+        return self.stopping.wait(RETENTION_PAUSE)
+
+    def load_state(self, folder):
+        try:
+            with open(os.path.join(folder, RETENTION_STATE), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, folder, state):
+        path = os.path.join(folder, RETENTION_STATE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(path + '.tmp', path)
+
+    def run_pass(self):
+        active = {os.path.abspath(folder) for folder in self.active_folders()}
+        sessions = list_sessions()
+        now = time.time()
+        for started, camera, folder in sessions:
+            if self.stopping.is_set():
+                return
+            if os.path.abspath(folder) in active:
+                continue
+            age_days = (now - started) / 86400
+            if self.delete_encoded_after is not None and age_days >= self.delete_encoded_after and is_encoded(folder):
+                self.delete_frames(folder)
+                continue
+            keep_every = max((n for days, n in self.rules if age_days >= days), default=1)
+            self.thin(folder, keep_every)
+
+        if self.camera_budget or self.total_budget:
+            self.enforce_budgets(sessions, active)
+        self.check_forecast()
+
+    def delete_frames(self, folder):
+        # Everything but the finished videos (and the marker saying they're finished)
+        freed = 0
+        for entry in list(os.scandir(folder)):
+            if entry.is_file() and not is_video(entry.name) and entry.name != ENCODED_MARKER:
+                freed += entry.stat().st_size
+                os.remove(entry.path)
+                if self.pause():
+                    break
+        freed += remove_thumbnails(folder)
+        if freed:
+            print(f"Retention: deleted the frames of {folder}, {freed / (1024 * 1024):.1f} MB freed")
+        self.record_freed(freed, 'delete_frames')
+        return freed
+
+    def thin(self, folder, keep_every):
+        # Brings a session down to every keep_every-th of the frames it was captured with
+        state = self.load_state(folder)
+        current = state.get('keep_every', 1)
+        if keep_every <= current:
+            return 0
+        store = open_frame_store(folder)
+        if store.count < 2:
+            return 0
+        before = folder_size(folder)
+        # Surviving frame i stands for captured frame i * current. Keep the first survivor in each run of keep_every
+        # captured frames, so going from 1 in 2 to 1 in 3 still thins (a plain [::keep_every // current] wouldn't).
+        keep = set()
+        last_run = None
+        for i, name in enumerate(store.frame_names()):
+            run = i * current // keep_every
+            if run != last_run:
+                keep.add(name)
+                last_run = run
+        if len(keep) == store.count:
+            return 0
+        if isinstance(store, FrameContainer):
+            self.compact_container(store, keep)
+        else:
+            self.thin_files(store, keep)
+        remove_thumbnails(folder, keep)
+        state['keep_every'] = keep_every
+        self.save_state(folder, state)
+        freed = max(0, before - folder_size(folder))
+        print(f"Retention: thinned {folder} to 1 in {keep_every} frames, {freed / (1024 * 1024):.1f} MB freed")
+        self.record_freed(freed, 'thin')
+        return freed
+
+    def thin_files(self, manifest, keep):
+        # Rewrite the manifest first, so a crash part way through just leaves some extra files behind
+        kept = [frame for frame in manifest.frames if frame[0] in keep]
+        with open(manifest.path + '.tmp', 'w') as file:
+            file.writelines(f"{name},{size},{ts}\n" for name, size, ts in kept)
+        os.replace(manifest.path + '.tmp', manifest.path)
+        for name, _, _ in manifest.frames:
+            if name in keep:
+                continue
+            try:
+                os.remove(os.path.join(manifest.folder, name))
+            except FileNotFoundError:
+                pass
+            if self.pause():
+                break
+
+    def compact_container(self, container, keep):
+        # Copy the kept frames into a new container, then swap it in (see finish_compaction)
+        records = []
+        offset = 0
+        with open(container.data_path + '.thin', 'wb') as data_file:
+            for _, timestamp, frame in container.read_frames(keep):
+                data_file.write(frame)
+                records.append((offset, len(frame), timestamp))
+                offset += len(frame)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        with open(container.index_path + '.thin.tmp', 'wb') as index_file:
+            index_file.write(b''.join(INDEX_RECORD.pack(*record) for record in records))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(container.index_path + '.thin.tmp', container.index_path + '.thin')
+        finish_compaction(container.data_path, container.index_path)
+
+    def enforce_budgets(self, sessions, active):
+        sizes = {folder: folder_size(folder) for _, _, folder in sessions}
+        camera_usage = {}
+        for _, camera, folder in sessions:
+            camera_usage[camera] = camera_usage.get(camera, 0) + sizes[folder]
+
+        def over_budget(camera):
+            if self.camera_budget and camera_usage[camera] > self.camera_budget:
+                return True
+            return bool(self.total_budget) and sum(camera_usage.values()) > self.total_budget
+
+        def shrunk(camera, folder):
+            new_size = folder_size(folder) if os.path.isdir(folder) else 0
+            camera_usage[camera] -= sizes[folder] - new_size
+            sizes[folder] = new_size
+
+        # Finished sessions, oldest first whichever camera they belong to
+        candidates = [(camera, folder) for _, camera, folder in sessions if os.path.abspath(folder) not in active]
+
+        # Each stage goes through every session before the next, harsher one starts on any of them.
+        # First the frames of sessions that already have their video.
+        for camera, folder in candidates:
+            if self.stopping.is_set():
+                return
+            if over_budget(camera) and open_frame_store(folder).count and is_encoded(folder):
+                self.delete_frames(folder)
+                shrunk(camera, folder)
+
+        # Then thin harder, a doubling at a time across all of them, so the oldest always end up the thinnest
+        thinning = True
+        while thinning and not self.stopping.is_set():
+            thinning = False
+            for camera, folder in candidates:
+                if self.stopping.is_set():
+                    return
+                keep_every = self.load_state(folder).get('keep_every', 1)
+                if not over_budget(camera) or keep_every >= MAX_THINNING:
+                    continue
+                if self.thin(folder, min(keep_every * 2, MAX_THINNING)):
+                    shrunk(camera, folder)
+                    thinning = True
+
+        # Only then delete whole sessions
+        for camera, folder in candidates:
+            if self.stopping.is_set():
+                return
+            if over_budget(camera) and os.path.isdir(folder):
+                freed = folder_size(folder)
+                shutil.rmtree(folder, ignore_errors=True)
+                print(f"Retention: deleted {folder} to stay within budget, {freed / (1024 * 1024):.1f} MB freed")
+                self.record_freed(freed, 'delete_session')
+                shrunk(camera, folder)
+
+        for camera, usage in camera_usage.items():
+            if self.camera_budget and usage > self.camera_budget:
+                print(f"Retention: {camera} is still over its budget, only its current session is left")
+        if self.total_budget and sum(camera_usage.values()) > self.total_budget:
+            print("Retention: still over the total budget, only current sessions are left")
+
+    def record_freed(self, freed, action):
+        self.freed_bytes += freed
+        metrics.inc('timelapse_retention_freed_bytes_total', freed, action=action)
+
+    def forecast(self):
+        # Free space on the snapshot disk and, at the current capture rate, roughly how many seconds until it's full
+        usage = shutil.disk_usage(SNAPSHOT_DIR if os.path.isdir(SNAPSHOT_DIR) else '.')
+        rate = self.capture_rate()
+        full_in = usage.free / rate if rate > 0 else None
+        if full_in is not None and self.total_budget and self.total_budget < usage.free:
+            # Retention deletes before the disk fills, unless the budget's bigger than the disk
+            full_in = None
+        return {'free': usage.free, 'total': usage.total, 'rate': rate, 'full_in': full_in}
+
+    def check_forecast(self):
+        forecast = self.forecast()
+        metrics.set('timelapse_disk_free_bytes', forecast['free'])
+        if forecast['full_in'] is not None:
+            metrics.set('timelapse_disk_full_seconds', forecast['full_in'])
+            if forecast['full_in'] < DISK_FULL_WARNING:
+                print(f"Warning: capturing {forecast['rate'] * 3600 / (1024 * 1024):.0f} MB/hour, the disk holding "
+                      f"{SNAPSHOT_DIR} will be full in about {forecast['full_in'] / 3600:.1f} hours. "
+                      f"Set a retention budget or free some space.")
+        return forecast
+
+def convert_session(folder, camera_ip, framerate=24, encoder=None, manifest=None, threads=None, on_progress=None,
+                    cancel=None, low_priority=False, deflicker=False):
+    framerate = str(framerate or '24')  # default to 24fps if not provided
+    output_filename = timelapse_filename(camera_ip)
+    if not os.path.isdir(folder):
+        print(f"No snapshots found in {folder}")
+        return False
+
+    # Only frames that aren't already in an encoded chunk get encoded, then the chunks are concatenated
+    if encoder is None or encoder.framerate != framerate or bool(encoder.deflicker) != bool(deflicker):
+        encoder = SegmentedEncoder(folder, framerate, camera=camera_ip, deflicker=deflicker)
+    encoder.threads = threads
+    encoder.low_priority = low_priority
+    try:
+        if manifest is None:
+            manifest = open_frame_store(folder)
+        encoder.manifest = manifest
+        image_files = manifest.frame_names()
+        output_path = os.path.join(folder, output_filename)
+
+        # Same frames and settings as something we've rendered before, hand that back without running ffmpeg
+        key = encoder.render_key(image_files, 'video')
+        if image_files and render_cache.fetch(key, output_path):
+            print(f"{folder} hasn't changed since it was last rendered, reused {output_filename} from the render cache")
+            mark_encoded(folder, output_path, len(image_files))
+            return True
+        if not encoder.finish(image_files, output_path, on_progress, cancel):
+            return False
+        mark_encoded(folder, output_path, len(image_files))
+        render_cache.store(key, output_path, f"{camera_ip} {os.path.basename(folder)}")
+        return True
+    except ConversionCancelled:
+        print(f"Conversion of {folder} cancelled, finished chunks are kept for next time.")
+        return False
+    except (OSError, RuntimeError, FFmpegNotFoundError) as exc:
+        print(f"Conversion of {folder} failed: {exc}")
+        return False
+
+def is_session_folder(folder):
+    if os.path.exists(os.path.join(folder, MANIFEST_FILE)) or os.path.exists(os.path.join(folder, CONTAINER_INDEX)):
+        return True
+    with os.scandir(folder) as entries:
+        return any(entry.name.startswith('image_') and entry.name.endswith('.jpeg') for entry in entries)
+
+def find_sessions(root):
+    # root itself if it holds frames, otherwise every session folder underneath it (e.g. all of SNAPSHOT_DIR)
+    sessions = []
+    for folder, subfolders, _ in os.walk(root):
+        if is_session_folder(folder):
+            sessions.append(folder)
+            subfolders[:] = []
+        else:
+            subfolders.sort()
+    return sessions
+
+def make_thumbnail(frame, width=THUMBNAIL_WIDTH):
+    # Draft mode has libjpeg decode at 1/2, 1/4 or 1/8 scale, so most of a big frame is never decoded at all
+    with Image.open(BytesIO(frame)) as image:
+        height = max(1, width * image.height // image.width)
+        image.draft('RGB', (width, height))
+        thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((width, height))
+    output = BytesIO()
+    thumbnail.save(output, 'JPEG', quality=THUMBNAIL_QUALITY)
+    return output.getvalue()
+
+def write_thumbnail(folder, name, frame):
+    path = os.path.join(folder, name)
+    try:
+        data = make_thumbnail(frame)
+    except (OSError, ValueError, SyntaxError) as exc:
+        print(f"Couldn't make a thumbnail of {name}: {exc}")
+        return False
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+def make_thumbnails(folder, manifest, names):
+    # Makes whichever thumbnails don't exist yet (a second preview of a session only does the new frames),
+    # a batch at a time across the CPU. Returns the names that have one, in frame order.
+    thumbnail_dir = os.path.join(folder, THUMBNAIL_DIR)
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    existing = set(os.listdir(thumbnail_dir))
+    missing = [name for name in names if name not in existing]
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        def write_batch(batch):
+            results = pool.map(lambda item: write_thumbnail(thumbnail_dir, *item), batch)
+            existing.update(name for (name, _), ok in zip(batch, results) if ok)
+
+        batch = []
+        for name, _, frame in manifest.read_frames(missing) if missing else ():
+            batch.append((name, bytes(frame)))
+            if len(batch) == FRAME_POOL_SIZE:  # Bounds how many full-size frames are held in memory at once
+                write_batch(batch)
+                batch = []
+        write_batch(batch)
+    return [name for name in names if name in existing]
+
+def remove_thumbnails(folder, keep=None):
+    # Thumbnails of frames that are no longer in keep (all of them without it), returns the bytes freed
+    thumbnail_dir = os.path.join(folder, THUMBNAIL_DIR)
+    freed = 0
+    if not os.path.isdir(thumbnail_dir):
+        return freed
+    for entry in list(os.scandir(thumbnail_dir)):
+        if keep is None or entry.name not in keep:
+            freed += entry.stat().st_size
+            os.remove(entry.path)
+    if keep is None:
+        os.rmdir(thumbnail_dir)
+    return freed
+
+def contact_sheet_frames(names):
+    # Evenly spread over the session, always including the first and last frame
+    tiles = CONTACT_SHEET_COLUMNS * CONTACT_SHEET_ROWS
+    if len(names) <= tiles:
+        return list(names)
+    return [names[round(i * (len(names) - 1) / (tiles - 1))] for i in range(tiles)]
+
+def make_contact_sheet(thumbnail_dir, names, output_path):
+    from PIL import ImageDraw
+    tiles = []
+    for name in contact_sheet_frames(names):
+        with Image.open(os.path.join(thumbnail_dir, name)) as tile:
+            tiles.append((name, tile.convert('RGB')))
+    if not tiles:
+        return False
+    tile_width = max(tile.width for _, tile in tiles)
+    tile_height = max(tile.height for _, tile in tiles)
+    rows = (len(tiles) + CONTACT_SHEET_COLUMNS - 1) // CONTACT_SHEET_COLUMNS
+    sheet = Image.new('RGB', (tile_width * min(len(tiles), CONTACT_SHEET_COLUMNS), tile_height * rows))
+    draw = ImageDraw.Draw(sheet)
+    for i, (name, tile) in enumerate(tiles):
+        x, y = i % CONTACT_SHEET_COLUMNS * tile_width, i // CONTACT_SHEET_COLUMNS * tile_height
+        sheet.paste(tile, (x, y))
+        # Label each tile with when it was taken (frame names are unix timestamps)
+        label = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(name[len('image_'):-len('.jpeg')])))
+        left, top, right, bottom = draw.textbbox((x + 3, y + 3), label)
+        draw.rectangle((x, y, right + 3, bottom + 3), fill='black')
+        draw.text((x + 3, y + 3), label, fill='white')
+    sheet.save(output_path + '.tmp', 'JPEG', quality=85)
+    os.replace(output_path + '.tmp', output_path)
+    return True
+
+def read_files(folder, names):
+    for name in names:
+        with open(os.path.join(folder, name), 'rb') as file:
+            yield file.read()
+
+def preview_session(folder, framerate=24, contact_sheet=True, manifest=None):
+    # A quick look at a session (even one that's still being captured): a small, fast-encoded PREVIEW_FILE and a
+    # CONTACT_SHEET_FILE. With Pillow both are made from cached thumbnails, without it ffmpeg scales the frames.
+    # Returns (preview path, contact sheet path), either can be None if it couldn't be made.
+    manifest = manifest or open_frame_store(folder)
+    names = manifest.frame_names()
+    if not names:
+        print(f"No frames to preview in {folder}")
+        return None, None
+    framerate = str(framerate or '24')
+    preview_path = os.path.join(folder, PREVIEW_FILE)
+    sheet_path = os.path.join(folder, CONTACT_SHEET_FILE) if contact_sheet else None
+    thumbnail_dir = os.path.join(folder, THUMBNAIL_DIR)
+
+    started = time.monotonic()
+    if Image is not None:
+        names = make_thumbnails(folder, manifest, names)
+
+    # The same frames previewed before come straight back out of the render cache
+    key = render_key(manifest.signatures(names), stage='preview', framerate=framerate, options=PREVIEW_OPTIONS,
+                     width=THUMBNAIL_WIDTH)
+    if not render_cache.fetch(key, preview_path):
+        # Written to a temp file and moved into place, as preview_path may be a hard link into the cache
+        temp_path = preview_path[:-len('.mp4')] + '.tmp.mp4'
+        arguments = [
+            '-y',
+            '-f', 'image2pipe',
+            '-framerate', framerate,
+            '-c:v', 'mjpeg',
+            '-i', '-',
+            '-vf', f'scale={THUMBNAIL_WIDTH}:-2',
+        ] + list(PREVIEW_OPTIONS) + [temp_path]
+        if Image is not None:
+            feed = read_files(thumbnail_dir, names)
+        else:
+            feed = (frame for _, _, frame in manifest.read_frames(names))
+        returncode = run_ffmpeg(arguments, feed=feed)
+        record_encode(os.path.basename(os.path.dirname(os.path.abspath(folder))), 'preview', len(names), time.monotonic() - started, returncode)
+        if returncode != 0:
+            print(f"ffmpeg failed making a preview of {folder}")
+            preview_path = None
+        else:
+            os.replace(temp_path, preview_path)
+            render_cache.store(key, preview_path, f"{os.path.basename(folder)} preview")
+
+    if sheet_path and Image is not None:
+        if not make_contact_sheet(thumbnail_dir, names, sheet_path):
+            sheet_path = None
+    elif sheet_path:
+        # ffmpeg's tile filter lays the frames out in a grid, emitting one image once they're all in
+        arguments = [
+            '-y',
+            '-f', 'image2pipe',
+            '-c:v', 'mjpeg',
+            '-i', '-',
+            '-vf', f'scale={THUMBNAIL_WIDTH}:-2,tile={CONTACT_SHEET_COLUMNS}x{CONTACT_SHEET_ROWS}',
+            '-frames:v', '1',
+            '-update', '1',
+            sheet_path
+        ]
+        if run_ffmpeg(arguments, feed=(frame for _, _, frame in manifest.read_frames(contact_sheet_frames(names)))) != 0:
+            print(f"ffmpeg failed making a contact sheet of {folder}")
+            sheet_path = None
+    print(f"Previewed {len(names)} frames of {folder} in {time.monotonic() - started:.1f}s")
+    return preview_path, sheet_path
+
+class ConversionJob:
+    # One folder waiting for, or going through, the conversion queue
+    def __init__(self, folder, camera_ip, framerate, encoder=None, manifest=None, low_priority=False, deflicker=False):
+        self.folder = folder
+        self.camera_ip = camera_ip
+        self.framerate = framerate
+        self.encoder = encoder
+        self.manifest = manifest
+        self.low_priority = low_priority
+        self.deflicker = deflicker
+        self.state = 'queued'  # then 'running', and 'done', 'failed' or 'cancelled'
+        self.frames_done = 0
+        self.frames_total = 0
+        self.started = None
+        self.cancel = Event()
+        self.future = None
+
+    def update(self, done, total):
+        self.frames_done = done
+        self.frames_total = total
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def describe(self):
+        name = f"{self.camera_ip} {os.path.basename(self.folder)}" + (" (background)" if self.low_priority else "")
+        if self.state != 'running':
+            return f"{name}: {self.state}"
+        if not self.frames_total:
+            return f"{name}: starting"
+        elapsed = time.monotonic() - self.started
+        fps = self.frames_done / elapsed if elapsed > 0 else 0
+        return f"{name}: {self.frames_done * 100 // self.frames_total}% ({self.frames_done}/{self.frames_total}, {fps:.0f} fps)"
+
+class ConversionQueue:
+    # Runs conversions side by side, sharing the CPU out between them with ffmpeg's -threads.
+    # Cancelling keeps any finished chunks (see SegmentedEncoder), so resuming only encodes what's left.
+    def __init__(self, max_jobs=CONVERT_JOBS):
+        cpus = os.cpu_count() or 1
+        self.max_jobs = max_jobs or max(1, min(4, cpus // 2))
+        self.threads = max(1, cpus // self.max_jobs)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        self.lock = Lock()
+        self.jobs = []
+
+    def submit(self, folder, camera_ip, framerate=24, encoder=None, manifest=None, low_priority=False, deflicker=False):
+        job = ConversionJob(folder, camera_ip, framerate, encoder, manifest, low_priority, deflicker)
+        with self.lock:
+            self.jobs.append(job)
+        job.future = self.executor.submit(self.run_job, job)
+        return job
+
+    def submit_tree(self, root, framerate=24, redo=False, deflicker=False):
+        # Every session under root (or root itself), skipping ones that already have a video unless redo is set.
+        # Snapshots live in SNAPSHOT_DIR/<camera>/<session>, so the parent folder is the camera.
+        jobs = []
+        for folder in find_sessions(root):
+            if not redo and any(is_video(name) for name in os.listdir(folder)):
+                continue
+            camera_ip = os.path.basename(os.path.dirname(os.path.abspath(folder))) or "Unknown_Camera"
+            jobs.append(self.submit(folder, camera_ip, framerate, deflicker=deflicker))
+        return jobs
+
+    def run_job(self, job):
+        if job.cancel.is_set():
+            job.state = 'cancelled'
+            return False
+        job.state = 'running'
+        job.started = time.monotonic()
+        ok = convert_session(job.folder, job.camera_ip, job.framerate, job.encoder, job.manifest, self.threads,
+                             job.update, job.cancel, job.low_priority, job.deflicker)
+        job.state = 'cancelled' if job.cancel.is_set() else 'done' if ok else 'failed'
+        return ok
+
+    def cancel(self, jobs=None):
+        for job in jobs if jobs is not None else list(self.jobs):
+            if not job.finished:
+                job.cancel.set()
+
+    def resume(self):
+        # Puts cancelled and failed jobs back in the queue
+        resumed = []
+        for job in list(self.jobs):
+            if job.state in ('cancelled', 'failed'):
+                job.cancel.clear()
+                job.state = 'queued'
+                job.frames_done = job.frames_total = 0
+                job.future = self.executor.submit(self.run_job, job)
+                resumed.append(job)
+        return resumed
+
+    def clear_finished(self):
+        with self.lock:
+            self.jobs = [job for job in self.jobs if not job.finished]
+
+    def wait(self, jobs):
+        return all(job.future.result() for job in jobs)
+
+class SessionJournal:
+    # An append-only JSON-lines record of one capture session, in SNAPSHOT_DIR next to the camera folders: the cameras
+    # and settings it started with, frame counts every JOURNAL_INTERVAL, when capture stopped and which cameras' videos
+    # are done. If the process dies part way, this is what lets the next run carry on capturing into the same folders
+    # and encode only what's left (the chunks themselves resume from segments.json). It's deleted once every video is done.
+    def __init__(self, session_name):
+        self.session_name = session_name
+        self.path = os.path.join(SNAPSHOT_DIR, session_name + JOURNAL_SUFFIX)
+        self.lock = Lock()
+        self.cameras = []
+        self.settings = {}
+        self.started = None
+        self.frames = {}  # camera -> frames at the last checkpoint
+        self.stopped = False
+        self.encoded = set()
+        self.checkpoint_stop = Event()
+        self.checkpoint_thread = None
+
+    def begin(self, cameras, settings, started):
+        self.cameras = list(cameras)
+        self.settings = dict(settings)
+        self.started = started
+        self.record('start', cameras=self.cameras, settings=self.settings, started=started)
+
+    def replay(self):
+        # Reads the journal back. A line cut short by a crash is the last one, so it's simply dropped.
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry['event'] == 'start':
+                    self.cameras = entry['cameras']
+                    self.settings = entry['settings']
+                    self.started = entry['started']
+                elif entry['event'] in ('frames', 'stopped'):
+                    self.frames.update(entry.get('frames') or {})
+                    self.stopped = self.stopped or entry['event'] == 'stopped'
+                elif entry['event'] == 'encoded':
+                    self.encoded.add(entry['camera'])
+        return self
+
+    def record(self, event, **fields):
+        line = json.dumps(dict(ts=round(time.time(), 3), event=event, **fields))
+        with self.lock:
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            with open(self.path, 'a') as file:
+                file.write(line + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+    def start_checkpoints(self, camera_totals):
+        # Records camera_totals()'s frame counts every JOURNAL_INTERVAL until stop_capture
+        self.checkpoint_stop.clear()
+        self.checkpoint_thread = Thread(target=self.checkpoint, args=(camera_totals,), daemon=True)
+        self.checkpoint_thread.start()
+
+    def checkpoint(self, camera_totals):
+        while not self.checkpoint_stop.wait(JOURNAL_INTERVAL):
+            self.record('frames', frames={camera: totals['frames'] for camera, totals in camera_totals().items()})
+
+    def stop_capture(self, totals):
+        self.checkpoint_stop.set()
+        if self.checkpoint_thread is not None:
+            self.checkpoint_thread.join()
+            self.checkpoint_thread = None
+        self.stopped = True
+        self.record('stopped', frames={camera: entry['frames'] for camera, entry in totals.items()})
+
+    def track(self, jobs):
+        # Records each camera's video as its conversion succeeds, and once they all have, the session's finished.
+        # One that fails or is cancelled leaves the journal behind so it gets another go next time.
+        remaining = {id(job) for job in jobs}
+        remaining_lock = Lock()
+
+        def job_done(job):
+            if job.state != 'done':
+                return
+            self.encoded.add(job.camera_ip)
+            self.record('encoded', camera=job.camera_ip)
+            with remaining_lock:
+                remaining.discard(id(job))
+                finished = not remaining
+            if finished:
+                self.finish()
+
+        if not jobs:
+            self.finish()
+        for job in jobs:
+            job.future.add_done_callback(lambda future, job=job: job_done(job))
+
+    def finish(self):
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+def unfinished_sessions():
+    # Journals left behind by sessions that were still capturing or encoding when the process died, newest first
+    journals = []
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return journals
+    for name in os.listdir(SNAPSHOT_DIR):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        try:
+            journal = SessionJournal(name[:-len(JOURNAL_SUFFIX)]).replay()
+        except (OSError, KeyError, TypeError) as exc:
+            print(f"Couldn't read the journal {name}: {exc}")
+            continue
+        if journal.started is not None:
+            journals.append(journal)
+    return sorted(journals, key=lambda journal: journal.started, reverse=True)
+
+class ShardCameraHealth:
+    # Stands in for the CameraHealth of a camera captured in a shard process, as of the shard's last report
+    def __init__(self, state, text):
+        self.state = state
+        self.text = text
+
+    def describe(self):
+        return self.text
+
+def run_capture_shard(index, cameras, session_name, settings, config, connection):
+    # The whole life of one shard process: an ordinary capture of its share of the cameras into the coordinator's
+    # session. It says 'ready' once imported, waits for the session clock, then sends a report down connection every
+    # SHARD_REPORT_INTERVAL until the coordinator sends anything else (that's the signal to stop) or goes away.
+    global SNAPSHOT_DIR
+    SNAPSHOT_DIR = config['snapshot_dir']
+    # Ctrl+C and a service manager's SIGTERM reach the whole process group, the coordinator decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Measurements go back in the reports and the coordinator saves them
+    estimator.path = config['estimates_path']
+    estimator.readonly = True
+    # Every shard saving its own view of the cache index would lose the others' entries, so chunks aren't cached here.
+    # The coordinator's conversion at stop still caches the finished video.
+    render_cache.budget = 0
+    if config['metrics_log']:
+        metrics.open_log(config['metrics_log'])
+
+    settings = dict(settings)
+    engine = TimelapseEngine()
+    engine.begin_session(cameras, settings.pop('framerate'), settings.pop('deflicker'), session_name)
+    try:
+        connection.send('ready')
+        clock = connection.recv()
+    except (EOFError, OSError):
+        return
+    engine.capturing.set()
+    engine.capture_locally(clock=clock, **settings)
+    try:
+        # poll() also returns when the coordinator's end is closed, so a dead coordinator stops us too
+        while not connection.poll(SHARD_REPORT_INTERVAL):
+            connection.send(engine.shard_report(index))
+    except OSError:
+        print(f"Capture shard {index} lost its coordinator, stopping.")
+    finally:
+        engine.halt_capture()
+        try:
+            connection.send(engine.shard_report(index))
+        except OSError:
+            pass
+        metrics.close_log()
+
+class ShardCoordinator:
+    # Splits one capture session across several worker processes, for fleets big enough that a single process
+    # runs out of GIL for the fetches, dedup and writes. Cameras are dealt out round robin and every shard schedules
+    # against the same clock origin (and, with spread on, offsets worked out across the whole fleet), so together they
+    # tick just as one process would. The clock only starts once every shard has started up, so none begins late.
+    # Each shard reports its frame counts, camera health, metrics and measurements every SHARD_REPORT_INTERVAL.
+    # A shard that dies is started again into the same session folders, which carry on from their manifests and
+    # segments.json, after SHARD_RESTART_DELAY (doubling while it keeps dying young).
+    # Each shard gets a pipe of its own rather than sharing a queue or event, so one killed mid-message can't wedge the rest.
+    def __init__(self, cameras, shards, session_name, settings):
+        # spawn everywhere: it's the only option on Windows, and forking a process that's running threads isn't safe
+        self.context = multiprocessing.get_context('spawn')
+        self.shards = [list(cameras[i::shards]) for i in range(shards)]
+        self.session_name = session_name
+        self.settings = settings
+        self.clock = None  # The shared scheduler start, see CameraScheduler
+        self.processes = [None] * shards
+        self.connections = [None] * shards  # Our end of each shard's pipe, None once it's closed
+        self.started = [0.0] * shards
+        self.failures = [0] * shards  # Deaths in a row, for the restart backoff
+        self.restarts = [0] * shards
+        self.restart_at = [None] * shards
+        self.ready = set()
+        self.reports = {}  # shard -> its latest report
+        self.last_tick = None
+        self.stopping = Event()
+        self.lock = Lock()
+        self.monitor_thread = None
+
+    def start(self):
+        for index in range(len(self.shards)):
+            self.launch(index)
+        # Hold the clock until every shard has imported everything, or the first deadlines would already be behind
+        deadline = time.monotonic() + SHARD_STARTUP_TIMEOUT
+        while len(self.ready) < len(self.shards) and time.monotonic() < deadline:
+            self.drain(0.1)
+            if any(not process.is_alive() for process in self.processes):
+                break
+        self.clock = time.monotonic()
+        for index in self.ready:
+            self.send(index, self.clock)
+        self.monitor_thread = Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+
+    def launch(self, index):
+        config = {
+            'snapshot_dir': SNAPSHOT_DIR,
+            'estimates_path': estimator.path,
+            'metrics_log': metrics.log_file.name if metrics.log_file is not None else None,
+        }
+        connection, shard_end = self.context.Pipe()
+        process = self.context.Process(target=run_capture_shard, name=f"capture-shard-{index}",
+                                       args=(index, self.shards[index], self.session_name, self.settings, config, shard_end))
+        process.start()
+        shard_end.close()  # Only the shard holds that end now, so we see EOF when it dies
+        self.processes[index] = process
+        self.connections[index] = connection
+        self.started[index] = time.monotonic()
+        self.restart_at[index] = None
+        self.ready.discard(index)
+        print(f"Capture shard {index} (pid {process.pid}) has {len(self.shards[index])} cameras")
+
+    def send(self, index, message):
+        try:
+            if self.connections[index] is not None:
+                self.connections[index].send(message)
+        except OSError:
+            pass  # It's died, check_processes will restart it
+
+    def monitor(self):
+        while not self.stopping.is_set():
+            self.drain(SHARD_REPORT_INTERVAL)
+            with self.lock:
+                if not self.stopping.is_set():
+                    self.check_processes()
+
+    def drain(self, timeout=0.0):
+        # Takes in every message waiting, blocking up to timeout for the first
+        while True:
+            open_connections = [connection for connection in self.connections if connection is not None]
+            ready = wait_connections(open_connections, timeout) if open_connections else []
+            if not ready:
+                return
+            timeout = 0
+            for connection in ready:
+                index = self.connections.index(connection)
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    # The shard has exited (or died), check_processes takes it from here
+                    connection.close()
+                    self.connections[index] = None
+                    continue
+                if message == 'ready':
+                    self.ready.add(index)
+                    if self.clock is not None:
+                        self.send(index, self.clock)  # A restarted shard joins the running session
+                else:
+                    self.absorb(message)
+
+    def absorb(self, report):
+        self.reports[report['shard']] = report
+        if report['last_tick'] is not None:
+            self.last_tick = report['last_tick']
+        metrics.absorb(report['metrics'], shard=str(report['shard']))
+        estimator.merge(report['estimates'])
+
+    def check_processes(self):
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if self.restart_at[index] is None:
+                process.join()
+                if now - self.started[index] > SHARD_RESTART_MAX:
+                    self.failures[index] = 0  # It had been running fine, so start from the short delay again
+                delay = min(SHARD_RESTART_MAX, SHARD_RESTART_DELAY * 2 ** self.failures[index])
+                self.failures[index] += 1
+                self.restart_at[index] = now + delay
+                print(f"Capture shard {index} died (exit code {process.exitcode}), restarting it in {delay:.0f}s")
+                metrics.event('shard_died', shard=index, exitcode=process.exitcode, restart_in=delay)
+            elif now >= self.restart_at[index]:
+                self.restarts[index] += 1
+                metrics.inc('timelapse_shard_restarts_total')
+                self.launch(index)
+        metrics.set('timelapse_shards_alive', sum(1 for process in self.processes if process.is_alive()))
+
+    def stop(self):
+        # Tells every shard to finish its tick and close up, and waits for them (reading their last reports)
+        with self.lock:
+            self.stopping.set()
+        self.monitor_thread.join()
+        for index in range(len(self.shards)):
+            self.send(index, 'stop')
+        # A shard blocks sending its last report until we read it, so keep draining while they wind down
+        deadline = time.monotonic() + SHARD_STOP_TIMEOUT
+        while any(process.is_alive() for process in self.processes) and time.monotonic() < deadline:
+            self.drain(0.2)
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                print(f"Capture shard {index} didn't stop in time, killing it")
+                process.kill()
+            process.join()
+        self.drain()
+        for connection in self.connections:
+            if connection is not None:
+                connection.close()
+        metrics.set('timelapse_shards_alive', 0)
+        estimator.save()
+
+    def camera_totals(self):
+        totals = {}
+        for report in list(self.reports.values()):
+            for camera, entry in report['cameras'].items():
+                totals[camera] = {key: value for key, value in entry.items() if key != 'health'}
+        return totals
+
+    def health(self):
+        # camera -> ShardCameraHealth, cameras whose shard is down (or hasn't reported yet) included
+        health = {}
+        for index, cameras in enumerate(self.shards):
+            reported = self.reports.get(index, {}).get('cameras', {})
+            running = self.processes[index] is not None and self.processes[index].is_alive()
+            for camera in cameras:
+                if not running:
+                    health[camera] = ShardCameraHealth('down', f"shard {index} restarting")
+                elif camera in reported:
+                    health[camera] = ShardCameraHealth(*reported[camera]['health'])
+                else:
+                    health[camera] = ShardCameraHealth('ok', "starting")
+        return health
+
+    def describe(self):
+        # One line per shard for status displays
+        lines = []
+        for index, cameras in enumerate(self.shards):
+            process = self.processes[index]
+            state = f"pid {process.pid}" if process is not None and process.is_alive() else "down"
+            frames = sum(entry['frames'] for entry in self.reports.get(index, {}).get('cameras', {}).values())
+            lines.append(f"shard {index}: {len(cameras)} cameras, {state}, {frames} frames, {self.restarts[index]} restarts")
+        return lines
+
+class TimelapseEngine:
+    # Capture sessions, the daily schedule and encoding, with no GUI attached.
+    # CameraApp is a thin client of one of these, and so is the command line interface below.
+    def __init__(self):
+        self.capturing = Event()
+        self.stop_requested = Event()  # Wakes the capture thread up straight away when we stop
+        self.lock = Lock()  # Start and stop can come from the GUI, the CLI or the schedule thread
+        self.session_name = None
+        self.start_time = None
+        self.cameras = []
+        self.framerate = '24'
+        self.deflicker = False
+        self.capture_thread = None
+        self.coordinator = None  # Set while capture is split across shard processes
+        self.journal = None  # The current session's SessionJournal
+        self.last_tick_report = None
+        self.manifests = {}
+        self.dedupers = {}
+        self.camera_health = {}
+        self.stream_encoders = {}
+        self.segment_encoders = {}
+        self.retention = RetentionManager(self.active_folders, self.capture_rate)
+        self.conversions = ConversionQueue()
+        self.subscribers = []
+        self.status_thread = None
+
+        # Schedule state: 'off', 'waiting' (outside the window) or 'recording'
+        self.schedule = None
+        self.schedule_settings = None
+        self.schedule_state = 'off'
+        self.schedule_next_change = None  # datetime of the next start or stop
+        self.schedule_stop = Event()
+        self.schedule_thread = None
+
+    def start_capture(self, cameras, frequency=10, framerate=24, stream_encode=False, dedup=False, intervals=None,
+                      offsets=None, spread=False, storage=FRAME_STORAGE, deflicker=False, shards=CAPTURE_SHARDS, resume=None):
+        # frequency is the default interval, intervals and offsets override it per camera (both in seconds).
+        # storage is 'files' (a JPEG per frame) or 'container' (one file per camera, see FrameContainer).
+        # deflicker evens out exposure changes (see Deflicker), which rules out encoding while capturing.
+        # shards above 1 splits the cameras across that many worker processes (see ShardCoordinator).
+        # resume is the SessionJournal of an unfinished session to carry on capturing into, see resume_sessions.
+        with self.lock:
+            if self.capturing.is_set():
+                return
+            self.capturing.set()
+            self.stop_requested.clear()
+            settings = {'frequency': frequency, 'framerate': framerate, 'stream_encode': stream_encode, 'dedup': dedup,
+                        'intervals': intervals, 'offsets': offsets, 'spread': spread, 'storage': storage,
+                        'deflicker': deflicker, 'shards': shards}
+            if resume is not None:
+                self.begin_session(cameras, framerate, deflicker, resume.session_name, resume.started)
+                self.journal = resume
+                self.journal.record('resumed')
+            else:
+                self.begin_session(cameras, framerate, deflicker)
+                self.journal = SessionJournal(self.session_name)
+                self.journal.begin(self.cameras, settings, self.start_time)
+            if deflicker and stream_encode:
+                print("Deflicker needs to see the frames after each one, so the video is encoded in chunks instead of while capturing.")
+                stream_encode = False
+
+            shards = min(shards or 1, len(self.cameras))
+            if shards > 1:
+                if stream_encode:
+                    print("Capture shards encode in chunks as they go rather than streaming into ffmpeg.")
+                if spread:
+                    # Work the offsets out across the whole fleet, so the shards stagger against each other too
+                    offsets = spread_offsets(self.cameras, {camera: float((intervals or {}).get(camera, frequency))
+                                                            for camera in self.cameras}, offsets)
+                settings = {'frequency': frequency, 'framerate': framerate, 'dedup': dedup, 'intervals': intervals,
+                            'offsets': offsets, 'spread': spread, 'storage': storage, 'deflicker': deflicker}
+                self.coordinator = ShardCoordinator(self.cameras, shards, self.session_name, settings)
+                self.coordinator.start()
+            else:
+                self.capture_locally(frequency, stream_encode, dedup, intervals, offsets, spread, storage)
+            self.journal.start_checkpoints(self.camera_totals)
+            self.retention.start()
+
+    def begin_session(self, cameras, framerate, deflicker, session_name=None, started=None):
+        self.session_name = session_name or time.strftime("%Y-%m-%d_%H-%M-%S")
+        self.start_time = started or time.time()
+        self.cameras = list(cameras)
+        self.framerate = str(framerate)
+        self.last_tick_report = None
+        self.deflicker = deflicker
+        self.manifests = {}
+        self.dedupers = {}
+        self.camera_health = {}
+        self.stream_encoders = {}
+        self.segment_encoders = {}
+
+    def capture_locally(self, frequency, stream_encode=False, dedup=False, intervals=None, offsets=None, spread=False,
+                        storage=FRAME_STORAGE, clock=None):
+        # Captures self.cameras on a thread in this process. clock is the scheduler's start, see CameraScheduler.
+        self.manifests = {camera: open_frame_store(os.path.join(SNAPSHOT_DIR, camera, self.session_name), storage)
+                          for camera in self.cameras}
+        self.dedupers = {camera: FrameDeduplicator() for camera in self.cameras} if dedup else {}
+        self.camera_health = {camera: CameraHealth(camera) for camera in self.cameras}
+
+        # Start one ffmpeg per camera up front if we're encoding while capturing
+        self.stream_encoders = {}
+        if stream_encode:
+            for camera in self.cameras:
+                folder_path = os.path.join(SNAPSHOT_DIR, camera, self.session_name)
+                os.makedirs(folder_path, exist_ok=True)
+                output_path = os.path.join(folder_path, timelapse_filename(camera))
+                self.stream_encoders[camera] = StreamingEncoder(output_path, self.framerate, camera=camera)
+
+        # Otherwise chip away at the encode in chunks while we capture, so stopping only has the tail left
+        self.segment_encoders = {}
+        if not self.stream_encoders:
+            for camera in self.cameras:
+                folder_path = os.path.join(SNAPSHOT_DIR, camera, self.session_name)
+                self.segment_encoders[camera] = SegmentedEncoder(folder_path, self.framerate, camera=camera,
+                                                                 deflicker=self.deflicker)
+                self.segment_encoders[camera].manifest = self.manifests[camera]
+
+        scheduler = CameraScheduler(self.cameras, frequency, intervals, offsets, spread, start=clock)
+        self.capture_thread = Thread(target=self.capture_images, args=(scheduler, self.cameras))
+        self.capture_thread.start()
+
+    def capture_images(self, scheduler, cameras):
+        engine = CaptureEngine(cameras, self.session_name, encoders=self.stream_encoders,
+                               manifests=self.manifests, dedupers=self.dedupers, health=self.camera_health)
+        # One background worker so chunk encodes queue up behind each other instead of fighting over the CPU
+        segment_worker = ThreadPoolExecutor(max_workers=1)
+        unencoded = {camera: 0 for camera in self.segment_encoders}
+        tick_lock = Lock()
+        ticks_done = [0]
+
+        def record_tick(report, lateness):
+            report['lateness'] = lateness
+            self.last_tick_report = report
+            metrics.observe('timelapse_tick_lateness_seconds', lateness)
+            metrics.observe('timelapse_tick_skew_seconds', report['skew'])
+            metrics.event('tick', session=self.session_name, lateness=round(lateness, 4), skew=round(report['skew'], 4),
+                          duration=round(report['duration'], 3), captured=report['captured'],
+                          failed=report['failed'], offline=report['offline'], write_queue=report['write_queue'])
+            with tick_lock:
+                ticks_done[0] += 1
+                if ticks_done[0] % LATENESS_REPORT_TICKS == 0:
+                    print(scheduler.summary())
+                    print(engine.writer.summary())
+
+                for camera in unencoded:
+                    if camera in report['captured_cameras']:
+                        unencoded[camera] += 1
+                    if unencoded[camera] >= SEGMENT_FRAMES:
+                        unencoded[camera] = 0
+                        segment_worker.submit(self.encode_segments_in_background, self.segment_encoders[camera])
+
+        try:
+            while self.capturing.is_set():
+                due = scheduler.wait(self.stop_requested)
+                if due is None:
+                    break
+                lateness, batch = due
+                try:
+                    if scheduler.spread:
+                        # Spread out, a batch is usually a single camera. Hand it to the fetchers and go straight
+                        # back to waiting, so a slow camera never holds up the ones due after it.
+                        engine.submit_tick(batch, lambda report, lateness=lateness: record_tick(report, lateness))
+                        continue
+                    report = engine.capture_tick(batch)
+                except Exception:
+                    # Don't let one bad tick silently end the whole session
+                    print("Capture tick failed:")
+                    traceback.print_exc()
+                    continue
+                record_tick(report, lateness)
+        except Exception:
+            print("Capture stopped unexpectedly:")
+            traceback.print_exc()
+        finally:
+            engine.close()
+            segment_worker.shutdown(wait=True)
+            for manifest in self.manifests.values():
+                manifest.close()
+            estimator.save()
+            print(scheduler.summary())
+            for camera, deduper in self.dedupers.items():
+                print(f"{camera}: skipped {deduper.frames_skipped} near-identical frames, "
+                      f"saved {deduper.bytes_saved / (1024 * 1024):.2f} MB")
+
+    def encode_segments_in_background(self, encoder):
+        try:
+            encoder.encode_full_segments(encoder.manifest.frame_names())
+        except (OSError, RuntimeError, FFmpegNotFoundError) as exc:
+            print(f"Background encode of {encoder.folder} failed, it'll be retried at stop: {exc}")
+
+    def stop_capture(self):
+        # Stops capturing and finishes every camera's video. Blocks until the encodes are done.
+        with self.lock:
+            if not self.capturing.is_set():
+                return
+            totals = self.halt_capture()
+            self.journal.stop_capture(totals)
+
+            jobs = []
+            if self.stream_encoders:
+                # Everything's already been encoded, just flush and finish each video
+                for camera, encoder in self.stream_encoders.items():
+                    if encoder.close() != 0 or encoder.failed:
+                        print(f"Streaming encode failed for {camera}, falling back to a full conversion.")
+                        jobs.append(self.conversions.submit(os.path.dirname(encoder.output_path), camera,
+                                                            self.framerate, manifest=self.manifests.get(camera)))
+                    else:
+                        mark_encoded(os.path.dirname(encoder.output_path), encoder.output_path, encoder.frames_written)
+                        self.journal.record('encoded', camera=camera)
+                self.stream_encoders = {}
+            else:
+                # Most chunks should already be encoded, this only has the tail left. Every camera at once.
+                # Sharded, the chunks were encoded in the shards, so segments.json is all there is to go on.
+                # A camera that never sent a frame has nothing to encode.
+                for camera in self.cameras:
+                    if not totals.get(camera, {}).get('frames'):
+                        continue
+                    folder_path = os.path.join(SNAPSHOT_DIR, camera, self.session_name)
+                    jobs.append(self.conversions.submit(folder_path, camera, self.framerate,
+                                                        self.segment_encoders.get(camera), self.manifests.get(camera),
+                                                        deflicker=self.deflicker))
+                self.segment_encoders = {}
+            self.journal.track(jobs)
+            self.journal = None
+            self.conversions.wait(jobs)
+
+    def finish_session(self, journal):
+        # Queues whatever encodes an unfinished session's journal says are left, without waiting for them
+        if not journal.stopped:
+            journal.stop_capture({})
+        jobs = []
+        for camera in journal.cameras:
+            folder_path = os.path.join(SNAPSHOT_DIR, camera, journal.session_name)
+            if camera in journal.encoded or not os.path.isdir(folder_path) or not is_session_folder(folder_path):
+                continue
+            jobs.append(self.conversions.submit(folder_path, camera, journal.settings.get('framerate', 24),
+                                                deflicker=journal.settings.get('deflicker', False)))
+        journal.track(jobs)
+        return jobs
+
+    def resume_sessions(self, journals, capture=True):
+        # Picks up after a crash (see unfinished_sessions): the newest session that was still capturing carries on
+        # capturing into the same folders if capture is set, every other one just gets its remaining encodes queued.
+        # Returns the journal of the session that's capturing again, if any.
+        resumed = None
+        for journal in journals:
+            if capture and resumed is None and not journal.stopped and not self.capturing.is_set():
+                print(f"Resuming session {journal.session_name} with {len(journal.cameras)} cameras")
+                self.start_capture(journal.cameras, resume=journal, **journal.settings)
+                resumed = journal
+            else:
+                print(f"Finishing the videos of session {journal.session_name}")
+                self.finish_session(journal)
+        return resumed
+
+    def halt_capture(self):
+        # Stops taking snapshots and waits until nothing is writing frames any more, without encoding anything.
+        # Returns the final camera_totals().
+        self.capturing.clear()
+        self.stop_requested.set()
+
+        # Let the capture thread (or every shard) finish its current tick
+        if self.capture_thread:
+            self.capture_thread.join()
+            self.capture_thread = None
+        totals = self.camera_totals()
+        if self.coordinator:
+            self.coordinator.stop()
+            totals = self.coordinator.camera_totals()
+            self.coordinator = None
+        return totals
+
+    def convert_folder(self, folder, camera_ip, framerate=24, encoder=None, manifest=None):
+        # Converts one folder right here, blocking. Use self.conversions to queue them up instead.
+        return convert_session(folder, camera_ip, framerate, encoder, manifest)
+
+    def start_schedule(self, windows, cameras, **capture_settings):
+        # windows is a list of ScheduleWindow. Capture starts and stops exactly on their boundaries.
+        self.stop_schedule()
+        self.schedule = list(windows)
+        self.schedule_settings = dict(capture_settings, cameras=cameras)
+        self.schedule_state = 'waiting'
+        self.schedule_stop.clear()
+        print("Schedule:", ', '.join(str(window) for window in self.schedule))
+        self.schedule_thread = Thread(target=self.run_schedule, daemon=True)
+        self.schedule_thread.start()
+
+    def run_schedule(self):
+        # Sleeps until the next start or stop instead of polling. The sleep is capped so a wall clock change
+        # (daylight saving, NTP) gets noticed, the boundary itself is still hit exactly.
+        while not self.schedule_stop.is_set():
+            recording, change_at = next_schedule_transition(self.schedule, datetime.now())
+            if recording and not self.capturing.is_set():
+                print(f"Inside scheduled time, recording until {change_at:%a %H:%M}.")
+                self.start_capture(**self.schedule_settings)
+            elif not recording and self.capturing.is_set():
+                print("Outside scheduled time.")
+                self.stop_capture()
+            self.schedule_state = 'recording' if recording else 'waiting'
+            self.schedule_next_change = change_at
+
+            wait = SCHEDULE_RESYNC_INTERVAL
+            if change_at is not None:
+                wait = min(wait, (change_at - datetime.now()).total_seconds())
+            self.schedule_stop.wait(max(0.0, wait))
+
+    def stop_schedule(self):
+        # Turns the schedule off, stopping (and encoding) any capture it started
+        if self.schedule_thread is None:
+            return
+        self.schedule_stop.set()
+        self.schedule_thread.join()
+        self.schedule_thread = None
+        self.schedule = None
+        self.schedule_state = 'off'
+        self.schedule_next_change = None
+        self.stop_capture()
+
+    def active_folders(self):
+        if not self.capturing.is_set():
+            return set()
+        return {os.path.join(SNAPSHOT_DIR, camera, self.session_name) for camera in self.cameras}
+
+    def camera_totals(self):
+        # camera -> frames, bytes and duplicates skipped so far this session, wherever it's being captured
+        if self.coordinator:
+            return self.coordinator.camera_totals()
+        totals = {}
+        for camera, manifest in list(self.manifests.items()):
+            deduper = self.dedupers.get(camera)
+            totals[camera] = {'frames': manifest.count, 'bytes': manifest.total_bytes,
+                              'skipped_frames': deduper.frames_skipped if deduper else 0,
+                              'skipped_bytes': deduper.bytes_saved if deduper else 0}
+        return totals
+
+    def capture_rate(self):
+        # Bytes per second the current session is adding to the disk
+        if not self.capturing.is_set() or not self.start_time:
+            return 0.0
+        elapsed = time.time() - self.start_time
+        return sum(totals['bytes'] for totals in self.camera_totals().values()) / elapsed if elapsed > 0 else 0.0
+
+    def shard_report(self, index):
+        # What a capture shard sends its coordinator, see run_capture_shard
+        cameras = self.camera_totals()
+        for camera, health in self.camera_health.items():
+            cameras[camera]['health'] = (health.state, health.describe())
+        return {
+            'shard': index,
+            'cameras': cameras,
+            'last_tick': self.last_tick_report,
+            'metrics': metrics.snapshot(),
+            'estimates': estimator.snapshot(self.cameras),
+        }
+
+    def subscribe(self):
+        # A queue of (kind, data) events for a front end to drain at its own pace, so it never has to call into the
+        # engine itself: 'status' (see status()) and 'conversions' (each queued job's describe()) every STATUS_INTERVAL.
+        # Anyone else may put their own events on it too, it's a plain thread-safe Queue.
+        events = Queue()
+        self.subscribers.append(events)
+        if self.status_thread is None:
+            self.status_thread = Thread(target=self.publish_status, daemon=True)
+            self.status_thread.start()
+        return events
+
+    def publish(self, kind, data):
+        for events in list(self.subscribers):
+            events.put((kind, data))
+
+    def publish_status(self):
+        # status() reads the disk and every camera's totals, which adds up with hundreds of cameras, so it's done here
+        while True:
+            try:
+                self.publish('status', self.status())
+                self.publish('conversions', [job.describe() for job in list(self.conversions.jobs)])
+            except Exception:
+                print("Couldn't publish the engine status:")
+                traceback.print_exc()
+            time.sleep(STATUS_INTERVAL)
+
+    def status(self):
+        # Snapshot of the current session for whoever's displaying it. Cheap, reads the manifests only.
+        totals = list(self.camera_totals().values())
+        coordinator = self.coordinator
+        return {
+            'capturing': self.capturing.is_set(),
+            'session': self.session_name,
+            'elapsed': time.time() - self.start_time if self.capturing.is_set() and self.start_time else 0,
+            'captures': sum(camera['frames'] for camera in totals),
+            'bytes': sum(camera['bytes'] for camera in totals),
+            # Each camera gets its own video, so the longest one decides the video length
+            'longest_video_frames': max((camera['frames'] for camera in totals), default=0),
+            'skipped_frames': sum(camera['skipped_frames'] for camera in totals),
+            'skipped_bytes': sum(camera['skipped_bytes'] for camera in totals),
+            'health': coordinator.health() if coordinator else dict(self.camera_health),
+            'shards': coordinator.describe() if coordinator else [],
+            'schedule_state': self.schedule_state,
+            'schedule_next_change': self.schedule_next_change,
+            'last_tick': coordinator.last_tick if coordinator else self.last_tick_report,
+            'disk': self.retention.forecast(),
+        }
+
+def parse_size(text):
+    # "500M", "20G", "1.5T" or plain bytes -> bytes
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = text.strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a size like 500M or 20G, got {text!r}")
+
+def parse_thinning_rule(text):
+    # "7:2" -> (7.0, 2), sessions older than 7 days keep every 2nd frame
+    try:
+        days, keep_every = text.split(':')
+        rule = (float(days), int(keep_every))
+    except ValueError:
+        rule = None
+    if rule is None or rule[1] < 2:
+        raise argparse.ArgumentTypeError(f"expected DAYS:N with N of at least 2, got {text!r}")
+    return rule
+
+def parse_weekdays(text):
+    # "mon-fri", "sat,sun" or "mon,wed-fri" -> {0, 1, 2, 3, 4}
+    days = set()
+    for part in text.lower().split(','):
+        first, _, last = part.strip().partition('-')
+        if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+            raise ValueError(f"unknown weekday in {text!r}")
+        first, last = WEEKDAYS.index(first), WEEKDAYS.index(last or first)
+        # Ranges can wrap around the weekend, e.g. fri-mon
+        days.update(day % 7 for day in range(first, last + 1 if last >= first else last + 8))
+    return days
+
+def parse_schedule(text):
+    # "08:00-17:00", "22:00-06:00" (overnight) or "mon-fri@08:00-17:00" -> ScheduleWindow
+    days, _, times = text.rpartition('@')
+    try:
+        start, end = (part.strip() for part in times.split('-'))
+        return ScheduleWindow(start, end, parse_weekdays(days) if days else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected [DAYS@]HH:MM-HH:MM, e.g. mon-fri@08:00-17:00, got {text!r}")
+
+def parse_camera_interval(text):
+    # "192.168.1.5=30" or "192.168.1.5=30+5" -> ("192.168.1.5", 30.0, 5.0 or None)
+    camera, _, timing = text.rpartition('=')
+    interval, _, offset = timing.partition('+')
+    try:
+        interval = float(interval)
+        offset = float(offset) if offset else None
+    except ValueError:
+        interval = 0
+    # Frames are named by the second they were taken, so anything faster would overwrite itself
+    if not camera or interval < 1:
+        raise argparse.ArgumentTypeError(f"expected CAMERA=SECONDS or CAMERA=SECONDS+OFFSET, got {text!r}")
+    return camera, interval, offset
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UniFi Camera Timelapse Creator, without the GUI.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('discover', help="find cameras and print their addresses")
+
+    capture_parser = commands.add_parser('capture', help="capture (optionally on a daily schedule) until stopped")
+    capture_parser.add_argument('--camera', action='append', default=[], help="camera address, repeat for more (default: discover)")
+    capture_parser.add_argument('--interval', type=int, default=10, help="seconds between snapshots (default: 10)")
+    capture_parser.add_argument('--interval-for', type=parse_camera_interval, action='append', default=[],
+                                metavar='CAMERA=SECONDS[+OFFSET]',
+                                help="a different interval (and phase offset) for one camera, repeat for more")
+    capture_parser.add_argument('--spread', action='store_true',
+                                help="stagger cameras evenly across their interval instead of fetching all at once")
+    capture_parser.add_argument('--fps', type=int, default=24, help="output video frame rate (default: 24)")
+    capture_parser.add_argument('--stream-encode', action='store_true', help="encode the video while capturing")
+    capture_parser.add_argument('--dedup', action='store_true', help="skip near-identical frames")
+    capture_parser.add_argument('--schedule', type=parse_schedule, action='append', default=[], metavar='[DAYS@]HH:MM-HH:MM',
+                                help="only capture inside this window, e.g. 08:00-17:00, mon-fri@08:00-17:00 or "
+                                     "22:00-06:00 (overnight), repeat for more")
+    capture_parser.add_argument('--deflicker', action='store_true', help="even out exposure flicker in the video (needs NumPy and Pillow)")
+    capture_parser.add_argument('--storage', choices=('files', 'container'), default=FRAME_STORAGE,
+                                help="'files' saves a JPEG per frame, 'container' appends them all to one file per camera")
+    capture_parser.add_argument('--resume', action='store_true',
+                                help="carry on a session that was cut short (and finish any other unfinished videos) "
+                                     "instead of starting a new one")
+    capture_parser.add_argument('--shards', type=int, default=CAPTURE_SHARDS,
+                                help="split the cameras across this many capture processes, for very large fleets (default: 1)")
+    capture_parser.add_argument('--camera-budget', type=parse_size, default=RETENTION_CAMERA_BUDGET,
+                                help="most disk space each camera may use, e.g. 20G (default: no limit)")
+    capture_parser.add_argument('--total-budget', type=parse_size, default=RETENTION_TOTAL_BUDGET,
+                                help="most disk space all cameras together may use (default: no limit)")
+    capture_parser.add_argument('--thin', type=parse_thinning_rule, action='append', metavar='DAYS:N',
+                                help="sessions older than DAYS keep only every Nth frame, repeat for more")
+    capture_parser.add_argument('--delete-encoded-after', type=float, default=DELETE_ENCODED_AFTER_DAYS, metavar='DAYS',
+                                help="delete the frames of sessions that already have a video after this many days")
+    capture_parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                                help="serve Prometheus metrics on http://HOST:PORT/metrics")
+    capture_parser.add_argument('--metrics-host', default=METRICS_HOST,
+                                help=f"address to serve metrics on, 0.0.0.0 for every interface (default: {METRICS_HOST})")
+    capture_parser.add_argument('--metrics-log', default=METRICS_LOG, help="append JSON-lines events to this file")
+
+    convert_parser = commands.add_parser('convert', help="turn folders of snapshots into timelapses")
+    convert_parser.add_argument('folders', nargs='+', metavar='folder',
+                                help="a session folder, or a folder of them (e.g. the whole snapshots folder)")
+    convert_parser.add_argument('--camera', help="name used in the output filename (default: the folder's camera)")
+    convert_parser.add_argument('--fps', type=int, default=24)
+    convert_parser.add_argument('--jobs', type=int, default=CONVERT_JOBS, help="conversions to run at once (default: from CPU count)")
+    convert_parser.add_argument('--redo', action='store_true', help="also convert sessions that already have a video")
+    convert_parser.add_argument('--deflicker', action='store_true', help="even out exposure flicker (needs NumPy and Pillow)")
+    convert_parser.add_argument('--no-cache', action='store_true', help="encode everything again, ignoring the render cache")
+
+    estimate_parser = commands.add_parser('estimate', help="project disk, bandwidth and encode time from past captures")
+    estimate_parser.add_argument('--camera', action='append', default=[], help="camera IP (default: every camera measured so far)")
+    estimate_parser.add_argument('--interval', type=float, default=10)
+    estimate_parser.add_argument('--fps', type=int, default=24)
+
+    preview_parser = commands.add_parser('preview', help="make a quick low-resolution preview and contact sheet of a session")
+    preview_parser.add_argument('folder')
+    preview_parser.add_argument('--fps', type=int, default=24)
+    preview_parser.add_argument('--no-sheet', action='store_true', help="skip the contact sheet")
+    preview_parser.add_argument('--full', action='store_true', help="then make the full-quality video at low priority")
+
+    cache_parser = commands.add_parser('cache', help="show how much the render cache is holding")
+    cache_parser.add_argument('--clear', action='store_true', help="delete every cached render")
+
+    commands.add_parser('prune', help="run one retention pass now with the settings at the top of this file")
+
+    export_parser = commands.add_parser('export', help="unpack a 'container' session folder back into loose JPEGs")
+    export_parser.add_argument('folder')
+    export_parser.add_argument('--output', help="where to put the JPEGs (default: the session folder itself)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'discover':
+        for camera in discover_cameras():
+            print(camera)
+        return 0
+
+    if args.command == 'export':
+        if not os.path.exists(os.path.join(args.folder, CONTAINER_INDEX)):
+            print(f"{args.folder} has no {CONTAINER_INDEX}, its frames are already loose JPEGs.")
+            return 1
+        print(f"Exported {export_container(args.folder, args.output)} frames to {args.output or args.folder}")
+        return 0
+
+    if args.command == 'estimate':
+        estimator.load()
+        cameras = args.camera or sorted(estimator.cameras)
+        if not cameras:
+            print("Nothing measured yet, capture something first (or pass --camera to use the defaults).")
+            return 1
+        for camera in cameras:
+            note = "" if estimator.measured(camera) else " (not measured yet)"
+            print(f"{camera}: {estimator.get(camera, 'frame_bytes') / 1024:.0f} KB/frame, "
+                  f"{estimator.get(camera, 'fetch_seconds') * 1000:.0f} ms/fetch, "
+                  f"{estimator.get(camera, 'encode_fps'):.0f} fps encode{note}")
+        estimate = estimator.estimate(cameras, args.interval, args.fps)
+        print(describe_estimate(estimate))
+        if args.interval < estimate['min_interval']:
+            print(f"Every {args.interval:g}s is faster than these cameras can keep up with.")
+        return 0
+
+    if args.command == 'preview':
+        folder = os.path.abspath(args.folder)
+        if not os.path.isdir(folder) or not is_session_folder(folder):
+            print(f"No snapshots found in {folder}")
+            return 1
+        get_ffmpeg_path()
+        preview_path, sheet_path = preview_session(folder, args.fps, not args.no_sheet)
+        for path in (preview_path, sheet_path):
+            if path:
+                print(path)
+        if args.full:
+            queue = ConversionQueue(1)
+            job = queue.submit(folder, os.path.basename(os.path.dirname(folder)), args.fps, low_priority=True)
+            signal.signal(signal.SIGINT, lambda signum, frame: queue.cancel([job]))
+            queue.wait([job])
+            print(job.describe())
+        return 0 if preview_path else 1
+
+    if args.command == 'cache':
+        if args.clear:
+            render_cache.clear()
+        count, size = render_cache.usage()
+        print(f"{count} renders, {size / (1024 * 1024):.1f} MB in {RENDER_CACHE_DIR}")
+        return 0
+
+    engine = TimelapseEngine()
+
+    if args.command == 'prune':
+        engine.retention.run_pass()
+        print(f"Freed {engine.retention.freed_bytes / (1024 * 1024):.1f} MB")
+        return 0
+
+    if args.command == 'convert':
+        if args.no_cache:
+            render_cache.budget = 0
+        get_ffmpeg_path()  # Before anything's queued, the jobs start running as soon as they're submitted
+        queue = ConversionQueue(args.jobs)
+        jobs = []
+        for folder in map(os.path.abspath, args.folders):
+            if not os.path.isdir(folder):
+                print(f"No snapshots found in {folder}")
+            elif is_session_folder(folder):
+                camera_ip = args.camera or os.path.basename(os.path.dirname(folder))
+                jobs.append(queue.submit(folder, camera_ip, args.fps, deflicker=args.deflicker))
+            else:
+                jobs += queue.submit_tree(folder, args.fps, args.redo, args.deflicker)
+        if not jobs:
+            print("Nothing to convert.")
+            return 0
+        print(f"Converting {len(jobs)} folders, {queue.max_jobs} at a time with {queue.threads} ffmpeg threads each")
+
+        # Ctrl+C cancels, run the same command again to pick up where it stopped
+        signal.signal(signal.SIGINT, lambda signum, frame: queue.cancel(jobs))
+        while wait_futures([job.future for job in jobs], timeout=5).not_done:
+            for job in jobs:
+                if job.state == 'running':
+                    print(job.describe())
+        for job in jobs:
+            print(job.describe())
+        return 0 if all(job.state == 'done' for job in jobs) else 1
+
+    intervals = {camera: interval for camera, interval, _ in args.interval_for}
+    offsets = {camera: offset for camera, _, offset in args.interval_for if offset is not None}
+    get_ffmpeg_path()  # Fail now rather than at the end of a long session
+    journals = unfinished_sessions() if args.resume else []
+    # Cameras only mentioned in --interval-for get captured too
+    cameras = args.camera + [camera for camera in intervals if camera not in args.camera]
+    if not cameras and not any(not journal.stopped for journal in journals):
+        cameras = discover_cameras()
+        if not cameras:
+            print("No cameras found.")
+            return 1
+    start_metrics(args.metrics_port, args.metrics_log, args.metrics_host)
+    engine.retention.camera_budget = args.camera_budget
+    engine.retention.total_budget = args.total_budget
+    engine.retention.rules = args.thin or THINNING_RULES
+    engine.retention.delete_encoded_after = args.delete_encoded_after
+
+    # Ctrl+C or a service manager's SIGTERM both stop capture and finish the videos
+    stopping = Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    settings = {'frequency': args.interval, 'framerate': args.fps, 'stream_encode': args.stream_encode, 'dedup': args.dedup,
+                'intervals': intervals, 'offsets': offsets, 'spread': args.spread, 'storage': args.storage,
+                'deflicker': args.deflicker, 'shards': args.shards}
+    resumed = engine.resume_sessions(journals)
+    if resumed is None and args.schedule:
+        engine.start_schedule(args.schedule, cameras, **settings)
+    elif resumed is None:
+        engine.start_capture(cameras, **settings)
+
+    while not stopping.wait(1.0):
+        pass
+    print("Stopping, finishing videos...")
+    engine.stop_schedule()
+    engine.stop_capture()
+    engine.conversions.wait(list(engine.conversions.jobs))  # Including videos of sessions that were only resumed to finish
+    metrics.close_log()
+    return 0
+
+if __name__ == "__main__":
+    try:
+        raise SystemExit(main())
+    except FFmpegNotFoundError as exc:
+        print(f"Error: {exc}")
+        raise SystemExit(1)
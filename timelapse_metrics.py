@@ -0,0 +1,179 @@
+# Instrumentation for timelapse_engine: counters, gauges and histograms labelled per camera,
+# served in Prometheus text format from an optional local HTTP endpoint, plus an optional JSON-lines event log.
+# Nothing is exported unless start_metrics() is called, recording is always on and cheap.
+
+import json
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+
+# Upper bounds (seconds) for the timing histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ENCODE_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+# name -> (type, help text, histogram buckets)
+METRICS = {
+    'timelapse_fetch_seconds': ('histogram', "Time to download one snapshot", LATENCY_BUCKETS),
+    'timelapse_fetch_bytes_total': ('counter', "Snapshot bytes downloaded", None),
+    'timelapse_fetch_failures_total': ('counter', "Failed snapshot downloads, by exception type", None),
+    'timelapse_frames_total': ('counter', "Frames captured", None),
+    'timelapse_tick_lateness_seconds': ('histogram', "How late each capture tick started", LATENCY_BUCKETS),
+    'timelapse_tick_skew_seconds': ('histogram', "Spread between the first and last camera in a tick", LATENCY_BUCKETS),
+    'timelapse_write_seconds': ('histogram', "Time to write one frame to disk", LATENCY_BUCKETS),
+    'timelapse_write_queue_depth': ('gauge', "Frames waiting for the disk writer", None),
+    'timelapse_encode_seconds': ('histogram', "Wall time of an ffmpeg run", ENCODE_BUCKETS),
+    'timelapse_encode_fps': ('gauge', "Frames per second achieved by the last ffmpeg run", None),
+    'timelapse_encoded_frames_total': ('counter', "Frames encoded by ffmpeg", None),
+    'timelapse_render_cache_total': ('counter', "Render cache lookups, by hit or miss", None),
+    'timelapse_discovery_seconds': ('gauge', "Wall time of the last camera discovery", None),
+    'timelapse_discovered_cameras': ('gauge', "Cameras found by the last discovery", None),
+    'timelapse_disk_free_bytes': ('gauge', "Free space on the snapshot disk", None),
+    'timelapse_disk_full_seconds': ('gauge', "Forecast seconds until the snapshot disk is full at the current capture rate", None),
+    'timelapse_retention_freed_bytes_total': ('counter', "Bytes freed by retention, by action", None),
+    'timelapse_shards_alive': ('gauge', "Capture shard processes currently running", None),
+    'timelapse_shard_restarts_total': ('counter', "Capture shard processes restarted after dying", None),
+}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        other = Histogram(self.buckets)
+        other.counts = list(self.counts)
+        other.sum = self.sum
+        other.count = self.count
+        return other
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in pairs) + '}'
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.values = {}  # (name, sorted label pairs) -> float or Histogram
+        self.log_file = None
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def snapshot(self):
+        # A consistent copy of every value, small enough to send between processes
+        with self.lock:
+            return {key: value.copy() if isinstance(value, Histogram) else value for key, value in self.values.items()}
+
+    def absorb(self, snapshot, **labels):
+        # Takes over another process's snapshot, with extra labels (e.g. shard="2") so the series don't collide.
+        # Snapshots are cumulative, so each one simply replaces the last.
+        extra = tuple(labels.items())
+        with self.lock:
+            for (name, own), value in snapshot.items():
+                self.values[name, tuple(sorted(own + extra))] = value
+
+    def event(self, kind, **fields):
+        # One JSON object per line, only if a log has been opened
+        if self.log_file is None:
+            return
+        line = json.dumps(dict(ts=round(time.time(), 3), event=kind, **fields), default=str)
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.write(line + '\n')
+                self.log_file.flush()
+
+    def open_log(self, path):
+        with self.lock:
+            self.log_file = open(path, 'a')
+
+    def close_log(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+    def render_prometheus(self):
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda item: item[0])
+            lines = []
+            current = None
+            for (name, labels), value in items:
+                kind, help_text, _ = METRICS[name]
+                if name != current:
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    current = name
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+# The registry everything in the engine records into
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics(port=None, log_path=None, host='127.0.0.1'):
+    # Serves http://host:port/metrics and/or opens the JSON-lines log. Either can be left off.
+    server = None
+    if port:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+    if log_path:
+        metrics.open_log(log_path)
+    return server